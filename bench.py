@@ -0,0 +1,350 @@
+
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import rba_v2
+import tokens as tokens_def
+
+
+RESULTS_VERSION = 1
+
+# the rules of make_rules are lexed and built for these
+DIRECTION = -1
+METRIC = 0
+
+# the databases the suite runs on, see make_rules, and the token streams run on them, see make_tokens
+SUITE = {
+    "small": dict(rules=200, clause_length=3, fanout=20, variable_density=0.1, length=5000, match_density=0.2),
+    "many-rules": dict(rules=5000, clause_length=4, fanout=200, variable_density=0.1, length=10000, match_density=0.2),
+    "long-clauses": dict(rules=1000, clause_length=10, fanout=50, variable_density=0.1, length=10000, match_density=0.2),
+    "narrow": dict(rules=1000, clause_length=5, fanout=4, variable_density=0.0, length=10000, match_density=0.2),
+    "wide": dict(rules=2000, clause_length=3, fanout=2000, variable_density=0.0, length=10000, match_density=0.2),
+    "variables": dict(rules=1000, clause_length=4, fanout=50, variable_density=0.5, length=10000, match_density=0.2),
+    "long-stream": dict(rules=500, clause_length=4, fanout=50, variable_density=0.1, length=20000, match_density=0.01),
+    "dense-matches": dict(rules=500, clause_length=4, fanout=50, variable_density=0.1, length=10000, match_density=0.9),
+}
+
+# which way each metric improves, others are reported but never flagged
+LOWER_IS_BETTER = ["parse_seconds", "build_seconds", "execute_seconds", "peak_build_bytes", "peak_execute_bytes"]
+HIGHER_IS_BETTER = ["tokens_per_second"]
+# changes in seconds smaller than this are timer noise, whatever fraction they are
+MIN_SECONDS = 0.01
+
+
+def measure(make, count:int):
+    """
+    Get the bytes allocated per object made by make(i)
+    not counting the list holding them
+    """
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    made = [None] * count
+    for i in range(count):
+        made[i] = make(i)
+    end = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (end - start) / count
+
+
+def memory_benchmark(count:int=100000):
+    """
+    Report the bytes used per token and per graph node
+    run_suite keeps them with its results, so compare flags objects that grew
+    """
+    # strings are made up front so they are not counted against the tokens
+    strings = [f"t{i}" for i in range(count)]
+    type_token = tokens_def.TypeToken(tokens_def.Token("#TYPE", "", 0), "", 0, [tokens_def.Token("int", "", 0)])
+    child = rba_v2.Node()
+
+    def make_node(i):
+        node = rba_v2.Node()
+        node.children[i] = child
+        return node
+
+    results = {
+        "token": measure(lambda i: tokens_def.Token(strings[i], "bench.c", i), count),
+        "variable token": measure(lambda i: tokens_def.VariableToken(strings[i], "bench.c", i, "vartoken", type_token), count),
+        "graph node (one edge)": measure(make_node, count),
+        "clause": measure(lambda i: rba_v2.Clause(), count),
+    }
+    return results
+
+
+def make_rules(rules:int, clause_length:int, fanout:int, variable_density:float, seed:int=0):
+    """
+    Make a rule database for DIRECTION and METRIC
+    Clause tokens are drawn from fanout words, so a small fanout makes long shared prefixes.
+    Each token is a variable with probability variable_density,
+    half of them #n wildcards and half bound to a $n the replacement uses.
+    Returns a list of rules, each a list of (content, metric) with the best clause last
+    """
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(fanout)]
+    result = []
+    for r in range(rules):
+        bound = []
+        clauses = []
+        for k in range(rng.randint(1, 2)):
+            content = []
+            for i in range(rng.randint(1, clause_length)):
+                if rng.random() >= variable_density:
+                    content.append(rng.choice(words))
+                elif k == 0 and rng.random() < 0.5:
+                    bound.append(len(bound) + 1)
+                    content.append(f"#{i+1}${bound[-1]}")
+                else:
+                    content.append(f"#{i+1}")
+            clauses.append((content, rng.randint(2, 9)))
+
+        # every other clause has to bind what the best one uses
+        for content, metric in clauses[1:]:
+            for n in bound:
+                content.insert(rng.randint(0, len(content)), f"#{len(content)+1}${n}")
+        best = [rng.choice(words) for i in range(rng.randint(0, max(0, clause_length - 2)))]
+        for n in bound:
+            best.insert(rng.randint(0, len(best)), f"v${n}")
+        if rng.random() < variable_density:
+            best.append("#1")
+        clauses.append((best, rng.randint(0, 1)))
+        result.append(clauses)
+    return result
+
+
+def database_text(rules:list):
+    """
+    Write rules from make_rules in the database format
+    """
+    lines = []
+    for clauses in rules:
+        lines.append(" = ".join(f'"{" ".join(content)}"~{metric}' for content, metric in clauses) + ";\n")
+    return "".join(lines)
+
+
+def make_tokens(rules:list, length:int, match_density:float, seed:int=0):
+    """
+    Make a token stream of about length tokens for rules from make_rules
+    A match_density share of the tokens are copies of clause contents, the rest match nothing
+    """
+    rng = random.Random(seed)
+    fillers = [f"x{i}" for i in range(100)]
+    result = []
+    while len(result) < length:
+        if rng.random() < match_density:
+            clauses = rng.choice(rules)
+            content = rng.choice(clauses[:-1])[0]
+            result += [rng.choice(fillers) if "#" in x else x for x in content]
+        else:
+            result.append(rng.choice(fillers))
+    return result[:length]
+
+
+def run_case(case:dict, seed:int=0, repeat:int=3, engine:str="trie"):
+    """
+    Measure one case of the suite
+    Times are the best of repeat runs, peak memory is taken in a separate run under tracemalloc
+    """
+    rules = make_rules(case["rules"], case["clause_length"], case["fanout"], case["variable_density"], seed)
+    stream = make_tokens(rules, case["length"], case["match_density"], seed)
+
+    handle, filename = tempfile.mkstemp(suffix=".rbe")
+    with os.fdopen(handle, 'w') as f:
+        f.write(database_text(rules))
+
+    # the circular check reports the cycles it finds
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            def read_rules():
+                for line, rule in rba_v2.read_database(filename, METRIC, DIRECTION):
+                    yield filename, line, rule
+
+            parse_seconds = build_seconds = execute_seconds = float("inf")
+            for i in range(repeat):
+                start = time.perf_counter()
+                lexed = list(read_rules())
+                parse_seconds = min(parse_seconds, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                graph = rba_v2.build_graph(lexed, DIRECTION)
+                build_seconds = min(build_seconds, time.perf_counter() - start)
+
+                stats = rba_v2.ExecuteStats()
+                start = time.perf_counter()
+                result, varnum = graph.execute(list(stream), engine=engine, stats=stats)
+                execute_seconds = min(execute_seconds, time.perf_counter() - start)
+
+            tracemalloc.start()
+            graph = rba_v2.build_graph(read_rules(), DIRECTION)
+            peak_build_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            graph.execute(list(stream), engine=engine)
+            peak_execute_bytes = tracemalloc.get_traced_memory()[1] - base
+            tracemalloc.stop()
+        finally:
+            os.remove(filename)
+
+    return {
+        "parse_seconds": parse_seconds,
+        "build_seconds": build_seconds,
+        "execute_seconds": execute_seconds,
+        "tokens_per_second": len(stream) / execute_seconds if execute_seconds > 0 else 0.0,
+        "passes": stats.passes,
+        "converged": result is not False,
+        "peak_build_bytes": peak_build_bytes,
+        "peak_execute_bytes": peak_execute_bytes,
+    }
+
+
+def run_suite(names:list[str]=None, seed:int=0, repeat:int=3, engine:str="trie"):
+    """
+    Run the cases of SUITE with the given names, or all of them
+    Returns the results in the form written to JSON
+    """
+    if names is None:
+        names = list(SUITE)
+    results = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "repeat": repeat,
+        "engine": engine,
+        "cases": {},
+        "memory": memory_benchmark(),
+    }
+    for name in names:
+        results["cases"][name] = {"parameters": SUITE[name], "metrics": run_case(SUITE[name], seed, repeat, engine)}
+    return results
+
+
+def compare_memory(baseline:dict, current:dict, threshold:float=0.1):
+    """
+    Compare memory_benchmark sizes against a baseline's
+    Returns rows like compare, under the case "memory", where growing more than threshold is a regression
+    """
+    rows = []
+    for name, value in current.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        change = (value - old) / old if old != 0 else 0.0
+        regressed = value > old if old == 0 else change > threshold
+        rows.append(("memory", name, old, value, change, regressed))
+    return rows
+
+
+def compare(baseline:dict, current:dict, threshold:float=0.1):
+    """
+    Compare suite results against a baseline
+    Returns (case, metric, baseline value, current value, change, regressed) for every metric in both,
+    where a change worse than threshold (a fraction) is a regression
+    """
+    rows = []
+    for name, case in current["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        old_metrics = baseline["cases"][name]["metrics"]
+        for metric, value in case["metrics"].items():
+            if metric not in old_metrics:
+                continue
+            old = old_metrics[metric]
+            if isinstance(value, bool):
+                # losing convergence is a regression, other flags are only reported
+                rows.append((name, metric, old, value, 0.0, metric == "converged" and old and not value))
+                continue
+            if old == 0:
+                # no fraction of zero to compare with, so counts that were zero regress when they get worse at all
+                change = 0.0
+                if metric.endswith("_seconds"):
+                    regressed = value - old >= MIN_SECONDS
+                elif metric in LOWER_IS_BETTER:
+                    regressed = value > old
+                else:
+                    regressed = metric == "passes" and value != old
+                rows.append((name, metric, old, value, change, regressed))
+                continue
+            change = (value - old) / old
+            if metric.endswith("_seconds") and abs(value - old) < MIN_SECONDS:
+                regressed = False
+            elif metric in LOWER_IS_BETTER:
+                regressed = change > threshold
+            elif metric in HIGHER_IS_BETTER:
+                regressed = change < -threshold
+            else:
+                # a different number of passes means the rewriting itself changed
+                regressed = metric == "passes" and value != old
+            rows.append((name, metric, old, value, change, regressed))
+    # results from before memory sizes were kept have none to compare
+    if "memory" in baseline and "memory" in current:
+        rows += compare_memory(baseline["memory"], current["memory"], threshold)
+    return rows
+
+
+def format_value(value):
+    return f"{value:.6g}" if isinstance(value, float) else str(value)
+
+
+def print_results(results:dict):
+    for name, case in results["cases"].items():
+        print(name)
+        for metric, value in case["metrics"].items():
+            print(f"    {metric}: {format_value(value)}")
+    if "memory" in results:
+        print("memory")
+        for name, size in results["memory"].items():
+            print(f"    {name}: {size:.1f} bytes")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "memory"
+    if command == "memory":
+        # bench.py memory [baseline.json] [threshold]
+        sizes = memory_benchmark()
+        for name, size in sizes.items():
+            print(f"{name}: {size:.1f} bytes")
+        if len(sys.argv) > 2:
+            with open(sys.argv[2], 'r') as f:
+                baseline = json.load(f)
+            threshold = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+            regressions = [row for row in compare_memory(baseline.get("memory", {}), sizes, threshold) if row[5]]
+            for case, name, old, value, change, regressed in regressions:
+                print(f"REGRESSION {name}: {old:.1f} -> {value:.1f} bytes ({change:+.1%})")
+            if len(regressions) > 0:
+                exit(1)
+    elif command == "suite":
+        # bench.py suite [output.json] [case...]
+        output = sys.argv[2] if len(sys.argv) > 2 else None
+        names = sys.argv[3:] if len(sys.argv) > 3 else None
+        results = run_suite(names)
+        print_results(results)
+        if output is not None:
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2)
+    elif command == "compare":
+        # bench.py compare <baseline.json> <current.json> [threshold]
+        if len(sys.argv) < 4:
+            print(f"Usage: {sys.argv[0]} compare <baseline.json> <current.json> [threshold]")
+            exit(1)
+        with open(sys.argv[2], 'r') as f:
+            baseline = json.load(f)
+        with open(sys.argv[3], 'r') as f:
+            current = json.load(f)
+        threshold = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+        regressions = 0
+        for name, metric, old, value, change, regressed in compare(baseline, current, threshold):
+            flag = "REGRESSION" if regressed else ""
+            print(f"{name:16} {metric:20} {format_value(old):>14} {format_value(value):>14} {change:>+8.1%} {flag}")
+            regressions += regressed
+        if regressions > 0:
+            print(f"{regressions} regressions over {threshold:.0%}")
+            exit(1)
+    else:
+        print(f"Unknown benchmark {command}")
+        exit(1)
@@ -0,0 +1,533 @@
+
+import array
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import rba_v2
+import tokens as tokens_def
+
+
+MAGIC = b"RBAG"
+FORMAT_VERSION = 2
+
+# magic, version, byte order, flags, key, max_length, head, then the item count and offset of each section
+HEADER = struct.Struct("<4sIBB32sII" + "QQ" * 10)
+SECTIONS = ["string_offsets", "string_data", "string_index", "nodes", "edges", "clauses", "metrics", "slots", "bases", "transitions"]
+
+# fields per row of the int tables
+NODE_FIELDS = 3 # first edge, edge count, clause index (-1 = no replacement)
+EDGE_FIELDS = 2 # label string id, child node
+CLAUSE_FIELDS = 4 # first slot, slot count, replacement clause index (-1 = none), flags
+SLOT_FIELDS = 5 # string id, kind, type string id (-1 = none), internal variable, external variable
+TRANSITION_FIELDS = 2 # owner node (-1 = free), child node
+
+# the edges are also placed in a double array of bases and transitions
+GRAPH_DOUBLE_ARRAY = 1
+# times a free transition can fail to start a node's edges before the search for a base stops trying it
+MAX_MISSES = 8
+
+KIND_TOKEN = 0
+KIND_VARIABLE = 1
+
+CLAUSE_HAS_METRIC = 1
+# a match can give the clause, kept as a minimized graph's merged nodes only give one of theirs
+CLAUSE_REWRITES = 2
+
+
+def database_hash(database_filenames:list[str], direction:int, metric:int, minimize:bool=False, double_array:bool=False):
+    """
+    Hash the contents of the database files and the arguments the graph was built with
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{FORMAT_VERSION}:{direction}:{metric}:{len(database_filenames)}".encode())
+    if minimize:
+        digest.update(b":minimized")
+    if double_array:
+        digest.update(b":double-array")
+    for filename in database_filenames:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        digest.update(struct.pack("<Q", len(data)))
+        digest.update(data)
+    return digest.digest()
+
+
+def string_hash(data:bytes):
+    return zlib.crc32(data)
+
+
+class Compiler:
+    """
+    Flattens a Graph into the tables of the compiled format
+    """
+    def __init__(self, graph:rba_v2.Graph, double_array:bool=False):
+        self.graph = graph
+        self.double_array = double_array
+        self.strings = []
+        self.string_ids = {}
+        self.clauses = []
+        self.clause_ids = {}
+
+        self.nodes = array.array('i')
+        self.edges = array.array('i')
+        self.clause_table = array.array('i')
+        self.metrics = array.array('d')
+        self.slots = array.array('i')
+        self.bases = array.array('i')
+        self.transitions = array.array('i')
+
+        # keep the graph's clause ids so traces can be replayed against either
+        for clause in graph.clauses:
+            self.clause_id(clause)
+        self.rewriting = {id(x) for x in graph.rewriting_clauses().values()}
+        self.head = self.add_nodes()
+        if double_array:
+            self.add_double_array()
+        self.add_clauses()
+
+    def string_id(self, string:str):
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    def clause_id(self, clause:rba_v2.Clause):
+        if id(clause) not in self.clause_ids:
+            self.clause_ids[id(clause)] = len(self.clauses)
+            self.clauses.append(clause)
+        return self.clause_ids[id(clause)]
+
+    def add_nodes(self):
+        """
+        Number the nodes breadth first and write the node and edge tables
+        """
+        order = [self.graph.head]
+        numbers = {id(self.graph.head): 0}
+        i = 0
+        while i < len(order):
+            for child in order[i].children.values():
+                if id(child) not in numbers:
+                    numbers[id(child)] = len(order)
+                    order.append(child)
+            i += 1
+
+        for node in order:
+            # edges are sorted by label id so a node's edges can be binary searched
+            edges = sorted((self.string_id(self.graph.symbols.string(label)), numbers[id(child)]) for label, child in node.children.items())
+            clause = self.graph.clause_at(node)
+            self.nodes.extend([len(self.edges) // EDGE_FIELDS, len(edges), -1 if clause is None else self.clause_id(clause)])
+            for label, child in edges:
+                self.edges.extend([label, child])
+        return 0
+
+    def add_double_array(self):
+        """
+        Place the edges of every node in one transition table, so the edge for a label is at base + label
+        A transition belongs to the node its owner field names, and nodes sharing a child each have a transition to it
+        """
+        owners = []
+        children = []
+        # the unused transitions in the table as a doubly linked list, -1 ends it,
+        # so the search for a base only visits transitions that can take the smallest label
+        next_free = []
+        previous_free = []
+        first_free = last_free = -1
+        # times each free transition was tried for the smallest label of a node that did not fit,
+        # one tried too often is left unused so later searches skip it
+        misses = []
+
+        def unlink(y):
+            nonlocal first_free, last_free
+            if previous_free[y] >= 0:
+                next_free[previous_free[y]] = next_free[y]
+            else:
+                first_free = next_free[y]
+            if next_free[y] >= 0:
+                previous_free[next_free[y]] = previous_free[y]
+            else:
+                last_free = previous_free[y]
+
+        for node in range(len(self.nodes) // NODE_FIELDS):
+            first = self.nodes[node*NODE_FIELDS]
+            count = self.nodes[node*NODE_FIELDS+1]
+            labels = [self.edges[(first+e)*EDGE_FIELDS] for e in range(count)]
+            if count == 0:
+                self.bases.append(0)
+                continue
+
+            # put the smallest label in each free transition in turn until the others fit too,
+            # every transition past the end of the table is free
+            x = first_free if first_free >= 0 else len(owners)
+            while True:
+                base = x - labels[0]
+                if all(base + label >= len(owners) or owners[base+label] < 0 for label in labels[1:]):
+                    break
+                following = next_free[x] if x < len(owners) and next_free[x] >= 0 else max(x + 1, len(owners))
+                if x < len(owners):
+                    misses[x] += 1
+                    if misses[x] >= MAX_MISSES:
+                        unlink(x)
+                x = following
+
+            end = base + labels[-1] + 1
+            if end > len(owners):
+                for y in range(len(owners), end):
+                    misses.append(0)
+                    next_free.append(-1)
+                    previous_free.append(last_free)
+                    if last_free >= 0:
+                        next_free[last_free] = y
+                    else:
+                        first_free = y
+                    last_free = y
+                owners += [-1] * (end - len(owners))
+                children += [-1] * (end - len(children))
+            for e, label in enumerate(labels):
+                y = base + label
+                owners[y] = node
+                children[y] = self.edges[(first+e)*EDGE_FIELDS+1]
+                if misses[y] < MAX_MISSES:
+                    unlink(y)
+            self.bases.append(base)
+
+        for owner, child in zip(owners, children):
+            self.transitions.extend([owner, child])
+
+    def add_clauses(self):
+        """
+        Write the clause and slot tables (clause_id may add replacements while this runs)
+        """
+        i = 0
+        while i < len(self.clauses):
+            clause = self.clauses[i]
+            replacement = -1 if clause.replacement is None else self.clause_id(clause.replacement)
+            flags = CLAUSE_HAS_METRIC if clause.metric is not None else 0
+            if id(clause) in self.rewriting:
+                flags |= CLAUSE_REWRITES
+            self.clause_table.extend([len(self.slots) // SLOT_FIELDS, len(clause.content), replacement, flags])
+            self.metrics.append(clause.metric if clause.metric is not None else 0.0)
+
+            for x, tok in enumerate(clause.content):
+                kind = KIND_TOKEN
+                the_type = -1
+                if isinstance(tok, tokens_def.VariableToken):
+                    kind = KIND_VARIABLE
+                    the_type = self.string_id(rba_v2.variable_type(tok))
+                internal = clause.internal_variables[x] if x < len(clause.internal_variables) else -1
+                external = clause.external_variables[x] if x < len(clause.external_variables) else -1
+                self.slots.extend([self.string_id(str(tok)), kind, the_type, internal, external])
+                # keep the literal of a pattern token like a* so the automaton engine can look it up
+                literal = rba_v2.pattern_element(str(tok))[0]
+                if literal is not None:
+                    self.string_id(literal)
+            i += 1
+
+    def string_sections(self):
+        """
+        Build the string offsets, the string data and an open addressing index over them
+        """
+        offsets = array.array('I', [0])
+        data = bytearray()
+        encoded = []
+        for string in self.strings:
+            raw = string.encode("utf-8")
+            encoded.append(raw)
+            data += raw
+            offsets.append(len(data))
+
+        size = 1
+        while size < 2 * len(self.strings) + 1:
+            size *= 2
+        index = array.array('I', [0] * size)
+        for string_id, raw in enumerate(encoded):
+            slot = string_hash(raw) & (size - 1)
+            while index[slot] != 0:
+                slot = (slot + 1) & (size - 1)
+            # 0 marks an empty slot
+            index[slot] = string_id + 1
+        return offsets, bytes(data), index
+
+    def write(self, filename:str, key:bytes):
+        """
+        Write the compiled graph to filename
+        The file is written next to its destination and renamed into place
+        """
+        offsets, data, index = self.string_sections()
+        sections = [
+            (len(offsets), offsets.tobytes()),
+            (len(data), data),
+            (len(index), index.tobytes()),
+            (len(self.nodes) // NODE_FIELDS, self.nodes.tobytes()),
+            (len(self.edges) // EDGE_FIELDS, self.edges.tobytes()),
+            (len(self.clause_table) // CLAUSE_FIELDS, self.clause_table.tobytes()),
+            (len(self.metrics), self.metrics.tobytes()),
+            (len(self.slots) // SLOT_FIELDS, self.slots.tobytes()),
+            (len(self.bases), self.bases.tobytes()),
+            (len(self.transitions) // TRANSITION_FIELDS, self.transitions.tobytes()),
+        ]
+
+        layout = []
+        body = bytearray()
+        position = HEADER.size
+        for count, raw in sections:
+            # keep every table 8 byte aligned
+            padding = -position % 8
+            body += b"\0" * padding
+            position += padding
+            layout += [count, position]
+            body += raw
+            position += len(raw)
+
+        byte_order = 0 if sys.byteorder == "little" else 1
+        flags = GRAPH_DOUBLE_ARRAY if self.double_array else 0
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, byte_order, flags, key, self.graph.max_length, self.head, *layout)
+
+        temp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(temp_filename, 'wb') as f:
+            f.write(header)
+            f.write(body)
+        os.replace(temp_filename, filename)
+
+
+def compile_graph(graph:rba_v2.Graph, filename:str, key:bytes=b"", minimize:bool=False, stats:rba_v2.MinimizeStats=None, double_array:bool=False):
+    """
+    Write graph to filename in the compiled format
+    With minimize, equal subtrees are written once (see rba_v2.minimize_graph)
+    With double_array, edges are followed by indexing instead of a binary search
+    """
+    graph = rba_v2.minimize_graph(graph, stats) if minimize else graph.snapshot()
+    Compiler(graph, double_array).write(filename, key.ljust(32, b"\0"))
+
+
+class CompiledGraph(rba_v2.BaseGraph):
+    """
+    A graph matched directly against a memory-mapped compiled file.
+    Clauses are only turned into Clause objects when a match needs their replacement
+    """
+    def __init__(self, filename:str):
+        rba_v2.BaseGraph.__init__(self)
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fields = HEADER.unpack_from(self.data, 0)
+        magic, version, byte_order, flags, self.key, self.max_length, self.head = fields[:7]
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a compiled graph")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{filename} has format version {version}, expected {FORMAT_VERSION}")
+        if byte_order != (0 if sys.byteorder == "little" else 1):
+            raise ValueError(f"{filename} was compiled on a machine with a different byte order")
+
+        self.view = memoryview(self.data)
+        view = self.view
+        layout = fields[7:]
+        formats = {"string_offsets": ('I', 1), "string_data": ('B', 1), "string_index": ('I', 1), "nodes": ('i', NODE_FIELDS),
+                   "edges": ('i', EDGE_FIELDS), "clauses": ('i', CLAUSE_FIELDS), "metrics": ('d', 1), "slots": ('i', SLOT_FIELDS),
+                   "bases": ('i', 1), "transitions": ('i', TRANSITION_FIELDS)}
+        tables = {}
+        for x, name in enumerate(SECTIONS):
+            count, position = layout[2*x], layout[2*x+1]
+            typecode, width = formats[name]
+            size = struct.calcsize(typecode) * count * width
+            tables[name] = view[position:position+size].cast(typecode)
+
+        self.string_offsets = tables["string_offsets"]
+        self.string_data = tables["string_data"]
+        self.string_index = tables["string_index"]
+        self.nodes = tables["nodes"]
+        self.edges = tables["edges"]
+        self.clause_table = tables["clauses"]
+        self.metrics = tables["metrics"]
+        self.slots = tables["slots"]
+        self.bases = tables["bases"]
+        self.transitions = tables["transitions"]
+        self.double_array = bool(flags & GRAPH_DOUBLE_ARRAY)
+        self.transition_count = len(self.transitions) // TRANSITION_FIELDS
+
+        # lookups already made against the file
+        self.string_ids = {}
+        self.strings = {}
+        self.clauses = {}
+        self.hash_id = self.lookup("#")
+
+    def string(self, string_id:int):
+        if string_id not in self.strings:
+            start = self.string_offsets[string_id]
+            end = self.string_offsets[string_id+1]
+            self.strings[string_id] = bytes(self.string_data[start:end]).decode("utf-8")
+        return self.strings[string_id]
+
+    def token_id(self, string:str):
+        return self.lookup(string)
+
+    def lookup(self, label:str):
+        """
+        Get the string id of label, or -1 if the file does not have it
+        """
+        if label in self.string_ids:
+            return self.string_ids[label]
+
+        raw = label.encode("utf-8")
+        mask = len(self.string_index) - 1
+        slot = string_hash(raw) & mask
+        result = -1
+        while self.string_index[slot] != 0:
+            string_id = self.string_index[slot] - 1
+            start = self.string_offsets[string_id]
+            end = self.string_offsets[string_id+1]
+            if self.string_data[start:end] == raw:
+                result = string_id
+                break
+            slot = (slot + 1) & mask
+
+        self.string_ids[label] = result
+        return result
+
+    def edge(self, node:int, label_id:int):
+        """
+        Find the child of node for label_id in the double array, or binary search the edges of node for it
+        """
+        if self.double_array:
+            x = self.bases[node] + label_id
+            if 0 <= x < self.transition_count and self.transitions[x*TRANSITION_FIELDS] == node:
+                return self.transitions[x*TRANSITION_FIELDS+1]
+            return None
+
+        first = self.nodes[node*NODE_FIELDS]
+        count = self.nodes[node*NODE_FIELDS+1]
+        x = bisect.bisect_left(range(count), label_id, key=lambda e: self.edges[(first+e)*EDGE_FIELDS])
+        if x < count and self.edges[(first+x)*EDGE_FIELDS] == label_id:
+            return self.edges[(first+x)*EDGE_FIELDS+1]
+        return None
+
+    def step(self, node:int, label:int):
+        """
+        Follow the edge for label out of node, falling back to the edge for its type and then the # edge
+        Returns None if there is no edge to follow
+        """
+        if type(label) is tuple:
+            label, typed = label
+            child = self.edge(node, label) if label >= 0 else None
+            if child is not None:
+                return child
+            child = self.edge(node, typed)
+            if child is not None:
+                return child
+        elif label >= 0:
+            child = self.edge(node, label)
+            if child is not None:
+                return child
+        if self.hash_id >= 0:
+            return self.edge(node, self.hash_id)
+        return None
+
+    def labels(self, node:int):
+        """
+        Get the labels of the edges out of node
+        """
+        first = self.nodes[node*NODE_FIELDS]
+        count = self.nodes[node*NODE_FIELDS+1]
+        return [self.edges[(first+e)*EDGE_FIELDS] for e in range(count)]
+
+    def clause_at(self, node:int):
+        """
+        Get the clause matched at node if it has a replacement
+        """
+        clause_id = self.nodes[node*NODE_FIELDS+2]
+        if clause_id < 0:
+            return None
+        return self.clause(clause_id)
+
+    def clause(self, clause_id:int):
+        """
+        Build the Clause object for clause_id
+        """
+        if clause_id in self.clauses:
+            return self.clauses[clause_id]
+
+        first, count, replacement, flags = self.clause_table[clause_id*CLAUSE_FIELDS:(clause_id+1)*CLAUSE_FIELDS]
+        clause = rba_v2.Clause()
+        clause.id = clause_id
+        # store before building the replacement in case clauses refer to each other
+        self.clauses[clause_id] = clause
+        clause.metric = self.metrics[clause_id] if flags & CLAUSE_HAS_METRIC else None
+        for x in range(first, first + count):
+            string_id, kind, the_type, internal, external = self.slots[x*SLOT_FIELDS:(x+1)*SLOT_FIELDS]
+            if kind == KIND_VARIABLE:
+                type_token = tokens_def.TypeToken(tokens_def.Token("#TYPE", "", 0), "", 0, [tokens_def.Token(self.string(the_type), "", 0)])
+                tok = tokens_def.VariableToken(self.string(string_id), "", 0, "vartoken", type_token)
+            else:
+                tok = tokens_def.Token(self.string(string_id), "", 0)
+            clause.content.append(tok)
+            clause.internal_variables.append(internal)
+            clause.external_variables.append(external)
+
+        if replacement >= 0:
+            clause.replacement = self.clause(replacement)
+            clause.template = rba_v2.Template(clause)
+        return clause
+
+    def clause_by_id(self, clause_id:int):
+        return self.clause(clause_id)
+
+    def rewriting_clauses(self):
+        clause_ids = [x for x in range(len(self.clause_table) // CLAUSE_FIELDS) if self.clause_table[x*CLAUSE_FIELDS+3] & CLAUSE_REWRITES]
+        return {x: self.clause(x) for x in clause_ids}
+
+    def close(self):
+        for table in [self.string_offsets, self.string_data, self.string_index, self.nodes, self.edges, self.clause_table, self.metrics, self.slots, self.bases, self.transitions]:
+            table.release()
+        self.view.release()
+        self.data.close()
+
+
+def load_database(database_filenames:list[str], direction:int, metric:int, cache_dir:str=".rba_cache", minimize:bool=False, double_array:bool=False):
+    """
+    Get a compiled graph for the databases, only parsing them
+    if the cache has no graph for their current contents
+    """
+    key = database_hash(database_filenames, direction, metric, minimize, double_array)
+    filename = os.path.join(cache_dir, key.hex() + ".rbg")
+
+    if os.path.exists(filename):
+        try:
+            graph = CompiledGraph(filename)
+            if graph.key == key:
+                return graph
+            graph.close()
+        except ValueError:
+            # written by another version, so rebuild it
+            pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    parser = rba_v2.Parser(database_filenames, direction, metric)
+    compile_graph(parser.graph, filename, key, minimize, double_array=double_array)
+    return CompiledGraph(filename)
+
+
+if __name__ == "__main__":
+    options = {"--minimize", "--double-array"}
+    arguments = [x for x in sys.argv[1:] if x not in options]
+    minimize = "--minimize" in sys.argv[1:]
+    double_array = "--double-array" in sys.argv[1:]
+    if len(arguments) < 4:
+        print(f"Usage: {sys.argv[0]} [--minimize] [--double-array] <output> <direction> <metric> <database>...")
+        exit(1)
+
+    output = arguments[0]
+    direction = int(arguments[1])
+    metric = int(arguments[2])
+    databases = arguments[3:]
+
+    parser = rba_v2.Parser(databases, direction, metric)
+    stats = rba_v2.MinimizeStats()
+    compile_graph(parser.graph, output, database_hash(databases, direction, metric, minimize, double_array), minimize, stats, double_array)
+    print(f"Compiled {databases} to {output}")
+    if minimize:
+        print(stats)
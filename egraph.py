@@ -0,0 +1,554 @@
+
+import copy
+import sys
+import time
+
+import parallel
+import rba_v2
+import tokens as tokens_def
+
+
+# limits on the search of execute_saturated
+MAX_NODES = 100000
+SECONDS = 1.0
+# costs closer than this are the same
+EPSILON = 1e-9
+
+
+def token_key(token):
+    """
+    Get what a token is matched and hash-consed by: its text and its type if it is a typed variable
+    """
+    return (str(token), rba_v2.variable_type(token))
+
+
+def element_key(token):
+    """
+    Get the pattern element a clause token is, as the trie matches it:
+    ("type", type) for a typed #, ("any",) for a #, and ("lit", text) for everything else
+    """
+    if isinstance(token, tokens_def.VariableToken) and str(token) == "#":
+        the_type = rba_v2.variable_type(token)
+        return ("type", the_type) if the_type != "" else ("any",)
+    return ("lit", str(token))
+
+
+def clause_metric(clause:rba_v2.Clause):
+    return clause.metric if clause.metric is not None else 0.0
+
+
+class RuleSet:
+    """
+    The rules of a graph as groups of equivalent clauses.
+    A group is the best clause of a rule and the clauses replaced by it.
+    The cost of a clause is how far its metric is from the best clause's,
+    so the best clause costs 0 whichever direction the rules were built for
+    """
+    def __init__(self, graph:rba_v2.BaseGraph):
+        # every clause with a replacement in the graph, clauses left out for cycles are not
+        found = graph.rewriting_clauses()
+
+        # clauses of each group by the id of its best clause, best first
+        self.groups = {}
+        self.group_of = {}
+        self.cost = {}
+        for clause_id in sorted(found):
+            clause = found[clause_id]
+            best = clause.replacement
+            group = self.groups.setdefault(best.id, [best])
+            group.append(clause)
+            self.group_of[clause.id] = best.id
+            self.group_of[best.id] = best.id
+            self.cost[clause.id] = abs(clause_metric(clause) - clause_metric(best))
+            self.cost[best.id] = 0.0
+
+        # trie of pattern elements, nodes are (children, clauses ending here)
+        self.root = ({}, [])
+        self.max_length = 0
+        for group in self.groups.values():
+            for clause in group:
+                if len(clause.content) == 0:
+                    continue
+                node = self.root
+                for x in clause.content:
+                    node = node[0].setdefault(element_key(x), ({}, []))
+                node[1].append(clause)
+                self.max_length = max(self.max_length, len(clause.content))
+
+
+class EGraph:
+    """
+    Token sequences as hash-consed cons cells.
+    An e-node is (token key, e-class of the rest of the sequence), e-class 0 is the empty sequence,
+    and e-classes are merged through a union-find when their sequences are equal at the same cost.
+    An e-class also has weighted rewrite edges to e-classes equal to it at a different cost
+    """
+    def __init__(self):
+        self.parent = [0]
+        # e-nodes of each e-class
+        self.nodes = [[]]
+        # rewrite edges of each e-class, {e-class: weight}
+        self.rewrites = [{}]
+        # e-classes with a node or edge into each e-class
+        self.users = [[]]
+        # e-class of every e-node
+        self.memo = {}
+        # a token for each key, the output is made from these
+        self.tokens = {}
+        self.node_count = 0
+        self.unions = 0
+        # e-classes that gained nodes or edges since the last take_touched
+        self.touched = set()
+
+    def find(self, c:int):
+        root = c
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[c] != root:
+            self.parent[c], c = root, self.parent[c]
+        return root
+
+    def make_class(self):
+        self.parent.append(len(self.parent))
+        self.nodes.append([])
+        self.rewrites.append({})
+        self.users.append([])
+        return len(self.parent) - 1
+
+    def add(self, token, child:int):
+        """
+        Get the e-class of token followed by the sequences of child
+        """
+        key = token_key(token)
+        child = self.find(child)
+        node = (key, child)
+        if node in self.memo:
+            return self.find(self.memo[node])
+        self.tokens.setdefault(key, token)
+        c = self.make_class()
+        self.nodes[c].append(node)
+        self.users[child].append(c)
+        self.memo[node] = c
+        self.node_count += 1
+        self.touched.add(c)
+        return c
+
+    def add_sequence(self, tokens:list, end:int=0):
+        c = end
+        for x in reversed(tokens):
+            c = self.add(x, c)
+        return c
+
+    def add_rewrite(self, c:int, e:int, weight:float):
+        """
+        Record that the sequences of c can be rewritten to those of e for weight
+        Returns True if that is new or cheaper than before
+        """
+        c = self.find(c)
+        e = self.find(e)
+        if c == e:
+            return False
+        edges = self.rewrites[c]
+        if e in edges and edges[e] <= weight + EPSILON:
+            return False
+        if e not in edges:
+            self.users[e].append(c)
+            self.node_count += 1
+        edges[e] = weight
+        self.touched.add(c)
+        return True
+
+    def union(self, a:int, b:int):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return False
+        # keep the e-class with more users as the root
+        if len(self.users[a]) < len(self.users[b]):
+            a, b = b, a
+        self.parent[b] = a
+        self.nodes[a] += self.nodes[b]
+        self.users[a] += self.users[b]
+        for e, weight in self.rewrites[b].items():
+            if e not in self.rewrites[a] or weight < self.rewrites[a][e]:
+                self.rewrites[a][e] = weight
+        self.nodes[b] = []
+        self.rewrites[b] = {}
+        self.users[b] = []
+        self.unions += 1
+        self.touched.add(a)
+        return True
+
+    def rebuild(self, deadline:float=None):
+        """
+        Restore hash-consing after unions, merging e-classes whose e-nodes became the same
+        Stops early at the deadline (a perf_counter time), leaving e-nodes that find() still has to be used on,
+        returns False if it did
+        """
+        while True:
+            memo = {}
+            congruent = []
+            for k, c in enumerate(self.classes()):
+                if deadline is not None and k % 256 == 0 and time.perf_counter() >= deadline:
+                    return False
+                for key, child in self.nodes[c]:
+                    node = (key, self.find(child))
+                    if node in memo and memo[node] != c:
+                        congruent.append((memo[node], c))
+                    else:
+                        memo[node] = c
+            for a, b in congruent:
+                self.union(a, b)
+            if len(congruent) == 0:
+                break
+
+        self.memo = memo
+        for c in self.classes():
+            self.nodes[c] = list(dict.fromkeys((key, self.find(child)) for key, child in self.nodes[c]))
+
+        for c in range(len(self.parent)):
+            if self.parent[c] != c or len(self.rewrites[c]) == 0:
+                continue
+            edges = {}
+            for e, weight in self.rewrites[c].items():
+                e = self.find(e)
+                if e != c and (e not in edges or weight < edges[e]):
+                    edges[e] = weight
+            self.rewrites[c] = edges
+        return True
+
+    def classes(self):
+        return [c for c in range(len(self.parent)) if self.parent[c] == c]
+
+    def take_touched(self, depth:int):
+        """
+        Get the e-classes a match of up to depth tokens could have changed for,
+        the ones touched since the last call and those up to depth - 1 tokens before them
+        """
+        touched = {self.find(c) for c in self.touched}
+        self.touched = set()
+        result = set(touched)
+        frontier = [(c, 0) for c in touched]
+        while len(frontier) > 0:
+            c, d = frontier.pop()
+            for user in self.users[c]:
+                user = self.find(user)
+                # a rewrite edge is followed without reading a token
+                steps = d if c in self.rewrites[user] else d + 1
+                if steps < depth and user not in result:
+                    result.add(user)
+                    frontier.append((user, steps))
+        return result
+
+    def matches(self, rules:RuleSet, start:int, deadline:float=None):
+        """
+        Find every clause of rules that matches a sequence of start, stopping early at the deadline (a perf_counter time)
+        Yields (clause, matched tokens, e-class after the match, weight of the rewrite edges crossed or None if none were)
+        """
+        # (pattern node, e-class, matched tokens, weight, e-classes reached since the last token)
+        stack = [(rules.root, self.find(start), (), None, ())]
+        # lowest weight each walk was seen with, a walk seen for less is not followed again
+        seen = {}
+        steps = 0
+        while len(stack) > 0:
+            steps += 1
+            if deadline is not None and steps % 256 == 0 and time.perf_counter() >= deadline:
+                return
+            pattern, c, matched, weight, crossed = stack.pop()
+            state = (id(pattern), c, tuple(token_key(x) for x in matched))
+            if state in seen and (weight or 0.0) >= seen[state] - EPSILON:
+                continue
+            seen[state] = weight or 0.0
+            for clause in pattern[1]:
+                yield clause, matched, c, weight
+            children = pattern[0]
+            if len(children) == 0:
+                continue
+            for key, child in self.nodes[c]:
+                token = self.tokens[key]
+                child = self.find(child)
+                accepted = [("lit", key[0]), ("any",)]
+                if key[1] != "":
+                    accepted.append(("type", key[1]))
+                for element in accepted:
+                    if element in children:
+                        stack.append((children[element], child, matched + (token,), weight, ()))
+            for e, edge_weight in self.rewrites[c].items():
+                e = self.find(e)
+                if e not in crossed:
+                    stack.append((pattern, e, matched, (weight or 0.0) + edge_weight, crossed + (c,)))
+
+    def extract(self, root:int, deadline:float=None):
+        """
+        Get the cheapest sequence of root and its cost
+        Costs are found depth first from root, leaving out the edges back to an e-class still being walked,
+        so an output is always finite even when the rules' costs give a cycle that keeps getting cheaper
+        Returns (tokens, cost), or None if the deadline (a perf_counter time) passes first
+        """
+        empty = self.find(0)
+        root = self.find(root)
+        # cost and (token key or None for a rewrite, next e-class) of every e-class walked
+        best = {empty: (0.0, None)}
+        done = {empty}
+        walking = {root}
+        stack = [(root, self.edges(root))] if root != empty else []
+        steps = 0
+        while len(stack) > 0:
+            steps += 1
+            if deadline is not None and steps % 256 == 0 and time.perf_counter() >= deadline:
+                return None
+            c, edges = stack[-1]
+            if len(edges) > 0:
+                key, e, weight = edges.pop()
+                if e not in done and e not in walking:
+                    walking.add(e)
+                    stack.append((e, self.edges(e)))
+                continue
+
+            stack.pop()
+            walking.discard(c)
+            done.add(c)
+            choice = None
+            # tokens are tried before rewrites, so a rewrite is only taken when it is cheaper
+            for key, e, weight in reversed(self.edges(c)):
+                if e in best and best[e][0] < float("inf") and (choice is None or best[e][0] + weight < choice[0] - EPSILON):
+                    choice = (best[e][0] + weight, (key, e))
+            best[c] = choice if choice is not None else (float("inf"), None)
+
+        result = []
+        c = root
+        while c != empty:
+            key, c = best[c][1]
+            if key is not None:
+                result.append(self.tokens[key])
+        return result, best[root][0]
+
+    def edges(self, c:int):
+        """
+        Get the (token key or None, next e-class, weight) of every way out of c, rewrites first
+        """
+        result = [(None, self.find(e), weight) for e, weight in self.rewrites[c].items()]
+        result += [(key, self.find(child), 0.0) for key, child in reversed(self.nodes[c])]
+        return result
+
+
+class SaturationStats:
+    """
+    Counters filled in by execute_saturated
+    """
+    def __init__(self):
+        self.iterations = 0
+        self.matches = 0
+        # rewrites that added an edge or merged e-classes
+        self.rewrites = 0
+        self.classes = 0
+        self.nodes = 0
+        self.unions = 0
+        # the search ran out of rewrites to make before reaching a limit
+        self.saturated = False
+        # total cost change of the output against the input, negative is better
+        self.cost = 0.0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return (f"SaturationStats(iterations={self.iterations}, matches={self.matches}, rewrites={self.rewrites}, "
+                f"classes={self.classes}, nodes={self.nodes}, unions={self.unions}, saturated={self.saturated}, "
+                f"cost={self.cost}, seconds={self.seconds:.3f})")
+
+
+def build(source:rba_v2.Clause, target:rba_v2.Clause, matched:list, fresh):
+    """
+    Build the tokens of target for a match of source, like BaseGraph.instantiate does for replacements
+    Internal variable n of the best clause is named by fresh(target, n),
+    other clauses can only be built if every variable in them is bound by the match
+    Returns None if target cannot be built
+    """
+    bound = {}
+    for x, n in enumerate(source.external_variables):
+        if n >= 0 and n not in bound:
+            bound[n] = matched[x]
+
+    result = []
+    for x, tok in enumerate(target.content):
+        external = target.external_variables[x]
+        internal = target.internal_variables[x]
+        tok = copy.copy(tok)
+        if external >= 0:
+            if external not in bound:
+                return None
+            tok.token = str(bound[external])
+        elif internal >= 0:
+            if target.replacement is not None:
+                # a # of a clause that is not the best one stands for any token, which cannot be made up
+                return None
+            tok.token = fresh(target, internal)
+        result.append(tok)
+    return result
+
+
+def execute_saturated(graph:rba_v2.BaseGraph, tokens:list, varnum:int=0, max_nodes:int=MAX_NODES, seconds:float=SECONDS, stats:SaturationStats=None):
+    """
+    Optimize tokens by equality saturation instead of greedy rewriting.
+    Every clause of a rule is applied as an equivalence in both directions, anywhere in the input,
+    until no rewrite adds anything or the e-graph has max_nodes nodes and edges or seconds have passed.
+    The output is the sequence with the lowest total cost (see RuleSet), so no order of rewrites
+    can block a better one the way a greedy pass can.
+    A search stopped by a limit can miss what greedy passes find, so their output is returned when it costs less.
+    Internal variables are numbered from varnum in the order they appear in the output.
+    Returns (tokens_def.Tokens, varnum) like BaseGraph.execute
+    """
+    start_time = time.perf_counter()
+    deadline = start_time + seconds
+    if stats is None:
+        stats = SaturationStats()
+    graph = graph.snapshot()
+    rules = RuleSet(graph)
+    tokens = list(tokens)
+
+    # the greedy output and its cost, counted against the time limit
+    log = parallel.EventLog()
+    greedy, greedy_varnum = graph.execute(list(tokens), varnum=varnum, trace=log)
+    greedy_cost = trace_cost(rules, log.events) if greedy is not False else float("inf")
+
+    egraph = EGraph()
+    root = egraph.add_sequence(tokens)
+
+    # new internal variables are named above every #n of the input, then renumbered from varnum
+    # a name stands for one variable of one clause wherever that clause is built, so rebuilding it adds nothing
+    top = varnum
+    for x in tokens:
+        n = parallel.variable_number(x)
+        if n is not None:
+            top = max(top, n + 1)
+    made = {}
+    # how many times each name is used in one build of its clause
+    uses = {}
+
+    def fresh(target:rba_v2.Clause, internal:int):
+        key = (target.id, internal)
+        if key not in made:
+            made[key] = f"#{top + len(made)}"
+            uses[made[key]] = target.internal_variables.count(internal)
+        return made[key]
+
+    applied = set()
+
+    def apply(c:int, found:list):
+        """
+        Add the rewrites of the matches found at e-class c
+        Returns True once a limit is reached
+        """
+        # a sequence several clauses of a rule match costs what the cheapest of them does
+        spans = {}
+        for source, matched, end, weight in found:
+            key = (rules.group_of[source.id], end, tuple(token_key(x) for x in matched), weight)
+            spans.setdefault(key, (matched, []))[1].append(source)
+
+        for (group, end, keys, weight), (matched, sources) in spans.items():
+            source_cost = min(rules.cost[x.id] for x in sources)
+            for target in rules.groups[group]:
+                if target in sources:
+                    continue
+                key = (egraph.find(c), target.id, egraph.find(end), keys, weight)
+                if key in applied:
+                    continue
+                applied.add(key)
+                built = None
+                for source in sources:
+                    built = build(source, target, list(matched), fresh)
+                    if built is not None:
+                        break
+                if built is None:
+                    continue
+                e = egraph.add_sequence(built, end)
+                weight_change = rules.cost[target.id] - source_cost + (weight or 0.0)
+                if abs(weight_change) <= EPSILON and weight is None:
+                    # the same cost both ways, the sequences are interchangeable
+                    changed = egraph.union(c, e)
+                else:
+                    changed = egraph.add_rewrite(c, e, weight_change)
+                stats.rewrites += changed
+                if egraph.node_count >= max_nodes or time.perf_counter() >= deadline:
+                    return True
+        return time.perf_counter() >= deadline
+
+    todo = egraph.take_touched(rules.max_length)
+    limited = False
+    while len(todo) > 0 and not limited:
+        stats.iterations += 1
+        for c in sorted(todo):
+            if limited:
+                break
+            if egraph.find(c) != c:
+                continue
+            # matches are all found before any is applied, unions would change the e-classes under the walk
+            found = list(egraph.matches(rules, c, deadline))
+            stats.matches += len(found)
+            limited = apply(c, found)
+
+        if not egraph.rebuild(deadline):
+            limited = True
+            break
+        todo = egraph.take_touched(rules.max_length)
+    stats.saturated = not limited
+
+    extracted = egraph.extract(root, deadline)
+    stats.classes = len(egraph.classes())
+    stats.nodes = egraph.node_count
+    stats.unions = egraph.unions
+    if extracted is None or greedy_cost < extracted[1] - EPSILON:
+        if greedy is False:
+            # nothing was extracted in time, and greedy passes could not make a replacement
+            greedy, greedy_varnum, greedy_cost = tokens_def.Tokens(tokens), varnum, 0.0
+        stats.cost = greedy_cost
+        stats.seconds = time.perf_counter() - start_time
+        return greedy, greedy_varnum
+    output, cost = extracted
+
+    # number the new internal variables in output order,
+    # every build of a clause gets its own, taken as the next uses[name] times the name appears
+    names = {}
+    seen = {}
+    result = []
+    for x in output:
+        name = str(x)
+        if name in uses:
+            if seen.get(name, 0) % uses[name] == 0:
+                names[name] = f"#{varnum}"
+                varnum += 1
+            seen[name] = seen.get(name, 0) + 1
+            x = copy.copy(x)
+            x.token = names[name]
+        result.append(x)
+
+    stats.cost = cost
+    stats.seconds = time.perf_counter() - start_time
+    return tokens_def.Tokens(result), varnum
+
+
+def trace_cost(rules:RuleSet, events:list):
+    """
+    Get the total cost change of the replacements BaseGraph.execute made, from parallel.EventLog events
+    """
+    return sum(-rules.cost[clause_id] for pass_number, position, clause_id, match_length, replacement_length in events)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print(f"Usage: {sys.argv[0]} <input> <direction> <metric> <database>...")
+        print("The input holds tokens separated by whitespace")
+        exit(1)
+
+    with open(sys.argv[1], 'r') as f:
+        tokens = f.read().split()
+    parser = rba_v2.Parser(sys.argv[4:], int(sys.argv[2]), int(sys.argv[3]))
+    graph = parser.graph
+
+    log = parallel.EventLog()
+    greedy, varnum = graph.execute(list(tokens), trace=log)
+    stats = SaturationStats()
+    result, varnum = execute_saturated(graph, tokens, stats=stats)
+    print(" ".join(str(x) for x in result))
+    print(stats)
+    if greedy is not False:
+        print(f"greedy cost: {trace_cost(RuleSet(graph), log.events)}, saturated cost: {stats.cost}")
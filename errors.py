@@ -20,6 +20,16 @@ class ErrorHandler:
             print("ENCOUNTERED FATAL ERROR!")
             self.finalize()
 
+    def add_errors(self, errors:list[Error], fatal:bool=True):
+        """
+        Add many errors at once, finalizing after the last of them if fatal
+        """
+        self.errors.extend(errors)
+
+        if fatal and len(errors) > 0:
+            print("ENCOUNTERED FATAL ERROR!")
+            self.finalize()
+
     def finalize(self):
         """
         If there are any errors, print and exit
@@ -0,0 +1,200 @@
+
+import collections
+import copy
+import hashlib
+import os
+import pickle
+
+import parallel
+import rba_v2
+import tokens as tokens_def
+
+
+class BlockCache:
+    """
+    Remembers how blocks of tokens were optimized, keyed by their content
+    with #n variables numbered in order of appearance.
+    Keeps at most capacity entries in memory, dropping the least recently used.
+    With a directory, entries are also kept on disk under key,
+    the hash of the rule databases (compiled.database_hash or CompiledGraph.key)
+    """
+    def __init__(self, capacity:int=1024, directory:str=None, key:bytes=b""):
+        self.capacity = capacity
+        self.key = key
+        self.directory = None
+        if directory is not None:
+            self.directory = os.path.join(directory, key.hex())
+            os.makedirs(self.directory, exist_ok=True)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # hits that had to be read from the directory
+        self.disk_hits = 0
+
+    def __repr__(self):
+        return f"BlockCache(entries={len(self.entries)}, hits={self.hits}, misses={self.misses}, disk_hits={self.disk_hits})"
+
+    def fingerprint(self, tokens:list):
+        digest = hashlib.sha256(self.key)
+        names = {}
+        for token in tokens:
+            x = str(token)
+            if parallel.variable_number(x) is not None:
+                x = f"#{names.setdefault(x, len(names))}"
+            digest.update(x.encode())
+            # typed variables match different clauses than the same text untyped
+            if isinstance(token, tokens_def.VariableToken):
+                digest.update(b"\1" + rba_v2.variable_type(token).encode())
+            digest.update(b"\0")
+        return digest.digest()
+
+    def path(self, fingerprint:bytes):
+        return os.path.join(self.directory, fingerprint.hex() + ".pickle")
+
+    def get(self, fingerprint:bytes):
+        """
+        Get the entry for a fingerprint, or None
+        """
+        if fingerprint in self.entries:
+            self.entries.move_to_end(fingerprint)
+            self.hits += 1
+            return self.entries[fingerprint]
+
+        if self.directory is not None:
+            try:
+                with open(self.path(fingerprint), 'rb') as f:
+                    entry = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                entry = None
+            if entry is not None:
+                self.remember(fingerprint, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, fingerprint:bytes, entry):
+        self.remember(fingerprint, entry)
+        if self.directory is not None:
+            # write then rename so a reader never sees half an entry
+            filename = self.path(fingerprint)
+            with open(filename + ".tmp", 'wb') as f:
+                pickle.dump(entry, f)
+            os.replace(filename + ".tmp", filename)
+
+    def remember(self, fingerprint:bytes, entry):
+        self.entries[fingerprint] = entry
+        self.entries.move_to_end(fingerprint)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def block_spans(tokens:list):
+    """
+    Cut tokens into the { } blocks at depth 0 and the runs between them
+    Returns the [start, end) of each
+    """
+    spans = []
+    start = 0
+    depth = 0
+    for i, x in enumerate(tokens):
+        x = str(x)
+        if x == "{":
+            if depth == 0 and i > start:
+                spans.append((start, i))
+                start = i
+            depth += 1
+        elif x == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                spans.append((start, i + 1))
+                start = i + 1
+    if start < len(tokens):
+        spans.append((start, len(tokens)))
+    return spans
+
+
+def make_entry(tokens:list, result, varnum:int):
+    """
+    Turn the optimize_shard result for tokens, run from varnum, into a cache entry
+    Output tokens taken from the input are kept as their index in it,
+    so a reuse takes them from its own block
+    """
+    output, end_varnum, allocations, edges = result
+    positions = {}
+    for i, x in enumerate(tokens):
+        positions.setdefault(id(x), i)
+
+    template = []
+    for x in output:
+        if id(x) in positions:
+            template.append(positions[id(x)])
+            continue
+        # made by a replacement: remember which of the block's own variables it is
+        n = parallel.variable_number(x)
+        template.append((x, n - varnum if n is not None and n >= varnum else -1))
+
+    allocations = [(pass_number, first - varnum, count) for pass_number, first, count in allocations]
+    return template, end_varnum - varnum, allocations, edges
+
+
+def use_entry(tokens:list, entry, varnum:int):
+    """
+    Rebuild the optimize_shard result for tokens, numbering its variables from varnum
+    """
+    template, used, allocations, edges = entry
+    output = []
+    for item in template:
+        if type(item) is int:
+            output.append(tokens[item])
+            continue
+        x, variable = item
+        x = copy.copy(x)
+        if variable >= 0:
+            x.token = f"#{varnum + variable}"
+        output.append(x)
+
+    allocations = [(pass_number, first + varnum, count) for pass_number, first, count in allocations]
+    return output, varnum + used, allocations, edges
+
+
+def execute_cached(graph, tokens:list, cache:BlockCache, varnum:int=0, engine:str="trie", incremental:bool=False):
+    """
+    Execute graph on tokens one { } block at a time, reusing the output of blocks seen before
+    Gives the same output and varnum as graph.execute(tokens, varnum=varnum)
+    """
+    # every block runs on one version of the rules
+    graph = graph.snapshot()
+    tokens = list(tokens)
+    if not graph.get_matcher(engine).follows_trie:
+        # block edges are checked by walking the trie, which other engines do not match like
+        return graph.execute(tokens, varnum=varnum, engine=engine, incremental=incremental)
+    width = max(0, graph.max_length - 1)
+
+    def run(jobs):
+        results = []
+        for block, base in jobs:
+            fingerprint = cache.fingerprint(block)
+            entry = cache.get(fingerprint)
+            if entry is not None:
+                results.append(use_entry(block, entry, base))
+                continue
+
+            result = parallel.optimize_shard(graph, block, base, engine, incremental, width)
+            if result is None:
+                results.append(None)
+                break
+            cache.put(fingerprint, make_entry(block, result, base))
+            results.append(result)
+        return results
+
+    result = parallel.execute_spans(graph, tokens, block_spans(tokens), varnum, run)
+    if result is None:
+        # the serial run fails at the same replacement, let it decide the returned varnum
+        return graph.execute(tokens, varnum=varnum, engine=engine, incremental=incremental)
+    return result
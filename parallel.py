@@ -0,0 +1,338 @@
+
+import contextlib
+import copy
+import gc
+import multiprocessing
+import os
+import tempfile
+import time
+
+import compiled
+import tokens as tokens_def
+
+
+OPENERS = ["(", "{", "["]
+CLOSERS = [")", "}", "]"]
+DELIMITERS = [";", "}"]
+
+# internal variables numbered by each shard start this far apart
+VARNUM_STRIDE = 1 << 32
+
+# graph the worker processes execute on, set once per worker
+_worker_graph = None
+
+
+def _init_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _open_worker(filename:str):
+    global _worker_graph
+    _worker_graph = compiled.CompiledGraph(filename)
+
+
+@contextlib.contextmanager
+def graph_pool(graph, workers:int):
+    """
+    Start a process pool whose workers all execute on graph, made once and shared
+    With fork the workers inherit the parent's graph,
+    otherwise they map a compiled copy of it so the pages are shared through the file
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        # keep the collector from writing to the graph's objects and copying their pages in the workers
+        gc.freeze()
+        try:
+            with multiprocessing.get_context("fork").Pool(workers, initializer=_init_worker, initargs=(graph,)) as pool:
+                yield pool
+        finally:
+            gc.unfreeze()
+        return
+
+    temporary = None
+    if isinstance(graph, compiled.CompiledGraph):
+        filename = graph.filename
+    else:
+        handle, temporary = tempfile.mkstemp(suffix=".rbc")
+        os.close(handle)
+        compiled.compile_graph(graph, temporary)
+        filename = temporary
+    try:
+        with multiprocessing.get_context().Pool(workers, initializer=_open_worker, initargs=(filename,)) as pool:
+            yield pool
+    finally:
+        if temporary is not None:
+            os.remove(temporary)
+
+
+class EventLog:
+    """
+    Keeps every replacement execute makes
+    Has the begin/record methods of rewrite_trace.Trace without its fixed capacity
+    """
+    def __init__(self):
+        self.varnum = 0
+        self.events = []
+
+    def begin(self, varnum:int):
+        self.varnum = varnum
+        self.events = []
+
+    def record(self, pass_number:int, position:int, clause_id:int, match_length:int, replacement_length:int):
+        self.events.append((pass_number, position, clause_id, match_length, replacement_length))
+
+
+def statement_ends(tokens:list):
+    """
+    Get the index after every ; or } at bracket depth 0
+    Unmatched closers are ignored instead of being errors
+    """
+    result = []
+    depth = 0
+    for i, x in enumerate(tokens):
+        x = str(x)
+        if x in OPENERS:
+            depth += 1
+        elif x in CLOSERS and depth > 0:
+            depth -= 1
+        if x in DELIMITERS and depth == 0:
+            result.append(i + 1)
+    return result
+
+
+def make_shards(tokens:list, count:int):
+    """
+    Cut tokens into about count shards of similar length at statement ends
+    Returns the [start, end) of each shard
+    """
+    target = len(tokens) / count
+    result = []
+    start = 0
+    for end in statement_ends(tokens):
+        if end - start >= target and end < len(tokens):
+            result.append((start, end))
+            start = end
+    result.append((start, len(tokens)))
+    return result
+
+
+def variable_number(token):
+    """
+    Get n for a #n token, or None
+    """
+    token = str(token)
+    if len(token) > 1 and token[0] == "#" and token[1:].isdigit():
+        return int(token[1:])
+    return None
+
+
+def run_shard(job):
+    return optimize_shard(_worker_graph, *job)
+
+
+def optimize_shard(graph, tokens:list, varnum:int, engine:str, incremental:bool, width:int):
+    """
+    Optimize one shard on its own
+    Returns the output, the varnum allocations of each replacement as (pass, first, count)
+    and the first and last width token strings at the start of every pass,
+    or None if execute could not make a replacement
+    """
+    log = EventLog()
+    result, end_varnum = graph.execute(list(tokens), varnum=varnum, engine=engine, incremental=incremental, trace=log)
+    if result is False:
+        return None
+
+    # replay to see the edges of the shard at the start of every pass
+    table = tokens_def.PieceTable(list(tokens))
+    allocations = []
+    edges = []
+    for pass_number, position, clause_id, match_length, replacement_length in log.events:
+        while len(edges) < pass_number:
+            edges.append(shard_edges(table, width))
+        clause = graph.clause_by_id(clause_id)
+        replacement, next_varnum = graph.instantiate(clause, table[position:position+match_length], varnum)
+        allocations.append((pass_number, varnum, next_varnum - varnum))
+        varnum = next_varnum
+        table.replace(position, position + match_length, replacement)
+    edges.append(shard_edges(table, width))
+
+    return list(result.tokens), end_varnum, allocations, edges
+
+
+def shard_edges(table, width:int):
+    n = len(table)
+    return edge_tokens(table[:min(n, width)]), edge_tokens(table[max(0, n - width):])
+
+
+def edge_tokens(tokens:list):
+    # typed variables are kept whole, their type decides which edges they follow
+    return [x if isinstance(x, tokens_def.VariableToken) else str(x) for x in tokens]
+
+
+def crosses(graph, left:list, right:list):
+    """
+    Check if the walk from any index of left can match a clause that ends in right
+    """
+    ids = graph.ingest(left + right)
+    for i in range(len(left)):
+        node = graph.head
+        k = i
+        while k < len(ids):
+            node = graph.step(node, ids[k])
+            if node is None:
+                break
+            k += 1
+            if k > len(left) and graph.clause_at(node) is not None:
+                return True
+    return False
+
+
+def unsafe_seams(graph, results:list, width:int):
+    """
+    Get the indices of shards whose end a match could have crossed in some pass
+    results hold the edges of every shard, see run_shard
+    """
+    if len(results) < 2:
+        return []
+    passes = max(len(result[3]) for result in results)
+    unsafe = []
+    for s in range(len(results) - 1):
+        for p in range(passes):
+            left = results[s][3][min(p, len(results[s][3]) - 1)][1]
+            # a short shard lets a walk reach the shards after it
+            right = []
+            for result in results[s+1:]:
+                if len(right) >= width:
+                    break
+                right += result[3][min(p, len(result[3]) - 1)][0]
+            if crosses(graph, left, right[:width]):
+                unsafe.append(s)
+                break
+    return unsafe
+
+
+def execute_sharded(graph, tokens:list, varnum:int=0, workers:int=None, shards:int=None, engine:str="trie", incremental:bool=False):
+    """
+    Execute graph on tokens by optimizing shards cut at statement ends in a process pool
+    Gives the same output and varnum as graph.execute(tokens, varnum=varnum)
+    """
+    # the shards all run on one version of the rules
+    graph = graph.snapshot()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if shards is None:
+        shards = workers
+    tokens = list(tokens)
+    # the checks at shard edges walk the trie, so other engines run serially
+    if workers <= 1 or shards <= 1 or graph.max_length == 0 or not graph.get_matcher(engine).follows_trie:
+        return graph.execute(tokens, varnum=varnum, engine=engine, incremental=incremental)
+
+    width = graph.max_length - 1
+    with graph_pool(graph, workers) as pool:
+        run = lambda jobs: pool.map(run_shard, [(x, base, engine, incremental, width) for x, base in jobs])
+        result = execute_spans(graph, tokens, make_shards(tokens, shards), varnum, run)
+    if result is None:
+        # the serial run fails at the same replacement, let it decide the returned varnum
+        return graph.execute(tokens, varnum=varnum, engine=engine, incremental=incremental)
+    return result
+
+
+def execute_spans(graph, tokens:list, spans:list, varnum:int, run):
+    """
+    Execute graph on tokens cut into spans that are each optimized on their own
+    run(jobs) gives the optimize_shard result for each (tokens, varnum) job
+    Spans a match could cross are merged and run again
+    Returns the same as graph.execute(tokens, varnum=varnum), or None if a span could not be optimized
+    """
+    # the numbers given to each span must be above every #n already in the input
+    top = varnum
+    for x in tokens:
+        n = variable_number(x)
+        if n is not None:
+            top = max(top, n + 1)
+
+    width = max(0, graph.max_length - 1)
+    spans = list(spans)
+    # a merged span keeps the numbers of its first part
+    bases = [top + s * VARNUM_STRIDE for s in range(len(spans))]
+    results = [None] * len(spans)
+
+    while True:
+        todo = [s for s in range(len(spans)) if results[s] is None]
+        jobs = [(tokens[spans[s][0]:spans[s][1]], bases[s]) for s in todo]
+        for s, result in zip(todo, run(jobs)):
+            if result is None:
+                return None
+            results[s] = result
+
+        unsafe = unsafe_seams(graph, results, width)
+        if len(unsafe) == 0:
+            break
+
+        # merge each unsafe seam and run the merged spans again
+        for s in reversed(unsafe):
+            spans[s:s+2] = [(spans[s][0], spans[s+1][1])]
+            bases[s:s+2] = [bases[s]]
+            results[s:s+2] = [None]
+
+    # number the internal variables in the order the serial run would have made them
+    allocations = []
+    for s, result in enumerate(results):
+        for order, (pass_number, first, count) in enumerate(result[2]):
+            allocations.append((pass_number, s, order, first, count))
+    allocations.sort()
+
+    renumber = {}
+    for pass_number, s, order, first, count in allocations:
+        for k in range(count):
+            renumber[first + k] = varnum
+            varnum += 1
+
+    output = []
+    for result in results:
+        for x in result[0]:
+            n = variable_number(x)
+            if n is not None and n in renumber:
+                if isinstance(x, str):
+                    x = f"#{renumber[n]}"
+                else:
+                    x = copy.copy(x)
+                    x.token = f"#{renumber[n]}"
+            output.append(x)
+    return tokens_def.Tokens(output), varnum
+
+
+def execute_item(graph, job):
+    """
+    Execute one input of execute_many
+    Returns (result, varnum, seconds)
+    """
+    tokens, varnum, engine, incremental = job
+    start = time.perf_counter()
+    result, varnum = graph.execute(list(tokens), varnum=varnum, engine=engine, incremental=incremental)
+    return result, varnum, time.perf_counter() - start
+
+
+def run_item(job):
+    return execute_item(_worker_graph, job)
+
+
+def execute_many(graph, inputs, workers:int=None, chunksize:int=None, varnum:int=0, engine:str="trie", incremental:bool=False):
+    """
+    Execute graph on each of many independent token lists in a process pool
+    Every input starts numbering internal variables from varnum, as separate execute calls would
+    Returns a (result, varnum, seconds) for each input, in input order
+    """
+    graph = graph.snapshot()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    jobs = ((tokens, varnum, engine, incremental) for tokens in inputs)
+    if workers <= 1:
+        return [execute_item(graph, job) for job in jobs]
+
+    if chunksize is None:
+        # a few chunks per worker keeps them busy without a round trip per input
+        count = len(inputs) if hasattr(inputs, "__len__") else 0
+        chunksize = max(1, count // (workers * 4))
+    with graph_pool(graph, workers) as pool:
+        return list(pool.imap(run_item, jobs, chunksize))
@@ -1,5 +1,14 @@
 
+import itertools
 import math
+import mmap
+import os
+import re
+import sys
+import threading
+
+import debug
+import errors
 import tokens as tokens_def
 
 
@@ -7,372 +16,2012 @@ class Clause:
     """
     A single clause of information to be added to the graph
     """
+    __slots__ = ("content", "replacement", "metric", "internal_variables", "external_variables", "id", "template")
+
     def __init__(self):
         self.content:list[str] = []
         self.replacement:Clause = None
         self.metric:float = 0.0
         self.internal_variables = []
         self.external_variables = []
+        # index in the graph's clause table
+        self.id = -1
+        # how to build the replacement for a match, made once the replacement is set (see Template)
+        self.template = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        self.template = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class Template:
+    """
+    The replacement of a clause compiled into slots,
+    so a match only makes the new tokens and fills in its variables
+    """
+    __slots__ = ("slots", "captures", "internal_count", "aligns")
+
+    def __init__(self, clause:Clause):
+        replacement = clause.replacement
+        # clauses made by hand may not have their variables filled in
+        internal_variables = replacement.internal_variables or [-1] * len(replacement.content)
+        external_variables = replacement.external_variables or [-1] * len(replacement.content)
+        # internal variables are numbered in the order they first appear
+        internal = {}
+        for the_var in internal_variables:
+            if the_var != -1 and the_var not in internal:
+                internal[the_var] = len(internal)
+        self.internal_count = len(internal)
+
+        # (class, other slots, token, internal variable's place or -1, external variable or -1) of each token
+        self.slots = []
+        for x, token in enumerate(replacement.content):
+            token = tokens_def.string_to_token(token)
+            state = token.__getstate__()
+            text = state.pop("token")
+            the_var = internal_variables[x]
+            self.slots.append((type(token), tuple(state.items()), text, internal.get(the_var, -1), external_variables[x]))
+
+        # (position in the match, external variable) of every binding of the content, the first one made wins
+        self.captures = [(x, the_var) for x, the_var in enumerate(clause.external_variables) if the_var != -1]
+        # a match of a pattern with repeats is not one token per element
+        self.aligns = any(pattern_element(str(x))[1] for x in clause.content)
+
+    def instantiate(self, clause:Clause, matched:list, varnum:int):
+        """
+        Build the replacement tokens for a match of clause, see BaseGraph.instantiate
+        """
+        if self.aligns or len(matched) != len(clause.content):
+            aligned = align(clause.content, matched)
+            if aligned is not None:
+                matched = aligned
+
+        bound = {}
+        for x, the_var in self.captures:
+            if the_var not in bound and matched[x] is not None:
+                bound[the_var] = matched[x]
+
+        result = []
+        for cls, state, text, internal, external in self.slots:
+            token = cls.__new__(cls)
+            for name, value in state:
+                setattr(token, name, value)
+            if external != -1:
+                if external not in bound:
+                    return None, varnum + self.internal_count
+                token.token = str(bound[external])
+            elif internal != -1:
+                token.token = f"#{varnum + internal}"
+            else:
+                token.token = text
+            result.append(token)
+        return result, varnum + self.internal_count
+
 
 class Node:
     """
     A single node for the graph.
     Allows following the graph to match strings
     """
+    __slots__ = ("children", "replacement", "clause", "count", "ending", "version")
+
     def __init__(self, replacement=None, clause=None):
         self.children = {}
         self.replacement = replacement
         self.clause = clause
+        # clauses whose content passes through this node
+        self.count = 0
+        # clauses with replacements that end here, oldest first, or None
+        self.ending = None
+        # the graph version the node was made for, older nodes are shared with snapshots
+        self.version = 0
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
 
-class Graph:
+def variable_type(token):
     """
-    Can be executed on an input list to optimize
+    Get the type of a VariableToken as one string, or "" if it has none
+    """
+    the_type = getattr(token, "type", None)
+    if the_type is None:
+        return ""
+    return "".join(str(x) for x in the_type.value)
+
+
+def edge_string(token):
+    """
+    Get the string the trie edge for a clause token is labelled with
+    A typed variable like #1(int gets an edge of its own, #(int
+    """
+    if isinstance(token, tokens_def.VariableToken):
+        the_type = variable_type(token)
+        if the_type != "":
+            return f"#({the_type}"
+    return str(token)
+
+
+class BaseGraph:
+    """
+    Can be executed on an input list to optimize.
+    Subclasses store the graph and provide the walk over it:
+    head, step(node, label), labels(node) and clause_at(node),
+    where labels are the int ids token_id(string) gives token strings,
+    or (id, id of the #(type edge) for typed variables whose type has an edge
     """
     def __init__(self):
-        self.head = Node()
+        self.matchers = {}
+        # length of the longest clause with a replacement
+        self.max_length = 0
 
-    def add_clause(self, clause:Clause, circular=False):
+    def get_matcher(self, engine:str="trie"):
         """
-        Add a clause object to the graph while handling circular rules
+        Get the matcher used by execute for the given engine name
         """
-        print(f"Adding clause...: {clause.content} -> {clause.replacement}")
-        
-        # add a new variable to function args: whether or not this is checking for circular rule: circular=False on first pass
-        if not circular and clause.replacement is not None: 
-            print(f"Checking circular: {clause.content} --- {clause.replacement.content}")
-            new_graph = Graph() # create a new graph 
-            
-            # create a copy of the original clause
-            new_clause = Clause()
-            new_clause.content = clause.content[:]
-            new_clause.replacement = Clause()
-            new_graph.add_clause(new_clause, circular=True)
-            replacement_made = new_graph.execute(clause.replacement.content, replace=False)
-            print("Replacement made:")
-            print(replacement_made)
-            
-            # if the execution ever made a replacement, stop execution
-            if replacement_made == True:
-                print(f"[Circular Check] Detected circular rule for clause: {clause.content}")
-                print(f"[Circular Check] Not adding clause to graph: {clause.content}")
-                # do not add to graph 
-                return
-            
-            print("No Circular rule detected for this clause")
-        
-
-        # add required nodes
-        current_node = self.head
-        for i, x in enumerate(clause.content):
-            #print(f"--- : {x} ")
-            if x in current_node.children:
-                #print("Already exists")
-                current_node = current_node.children[x]
-            else:
-                #print("Creating new node")
-                new_node = Node()
-                if i == len(clause.content)-1:
-                    print(f"Gave node a replacement of {clause.replacement}")
-                    new_node.replacement = clause.replacement
-                    new_node.clause = clause
+        if engine not in self.matchers:
+            if engine not in ENGINES:
+                raise ValueError(f"Unknown engine '{engine}'. Expected one of {list(ENGINES)}")
+            self.matchers[engine] = ENGINES[engine](self)
+        return self.matchers[engine]
 
-                current_node.children[x] = new_node
-                current_node = new_node
+
+    def snapshot(self):
+        """
+        Get a graph that keeps the current rules while this one changes
+        Graphs that cannot change are their own snapshot
+        """
+        return self
+
+
+    def ingest(self, tokens):
+        """
+        Get the ids the graph is matched on for a list of tokens
+        """
+        token_id = self.token_id
+        return [token_id(str(x)) if not isinstance(x, tokens_def.VariableToken) else self.variable_label(x) for x in tokens]
+
+    def rewriting_clauses(self):
+        """
+        Get every clause with a replacement a match can give, by id
+        """
+        clauses = {}
+        seen = set()
+        stack = [self.head]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            clause = self.clause_at(node)
+            if clause is not None:
+                clauses[clause.id] = clause
+            stack += [self.step(node, label) for label in self.labels(node)]
+        return clauses
+
+    def variable_label(self, token):
+        """
+        Get the label of an input variable, with the id of its type's edge if the graph has one
+        """
+        label = self.token_id(str(token))
+        the_type = variable_type(token)
+        if the_type == "":
+            return label
+        typed = self.token_id(f"#({the_type}")
+        return (label, typed) if typed >= 0 else label
+
+
+    def instantiate(self, clause:Clause, matched:list, varnum:int):
+        """
+        Build the replacement tokens for a match of clause
+        Returns None for the replacement if it cannot be made
+        """
+        template = clause.template
+        if template is None:
+            template = clause.template = Template(clause)
+        return template.instantiate(clause, matched, varnum)
 
 
     # optimize the graph 
-    def execute(self, tokens:list[str], replace=True, varnum=0):
+    def execute(self, tokens:list[str], replace=True, varnum=0, engine="trie", incremental=False, stats=None, piece_table=False, trace=None, profile=None, passes=None):
         """
         Execute the current graph on a list of strings
         Replaces matched token sequences with the replacement string 
+        engine selects how matches are found (see ENGINES)
+        incremental only rescans the windows around the last pass's replacements
+        stats (ExecuteStats) is filled in with counters for the run
+        piece_table rewrites a tokens.PieceTable in place instead of rebuilding the list
+        (a PieceTable passed as tokens is always rewritten in place)
+        trace (rewrite_trace.Trace) records every replacement made
+        profile (rule_profile.RuleProfile) counts the work done for each clause and pass
+        passes stops the run after that many passes, giving the tokens as they are then
         """
-        
+        view = self.snapshot()
+        if view is not self:
+            # run on one version of the rules even if they change during the run
+            return view.execute(tokens, replace, varnum, engine, incremental, stats, piece_table, trace, profile, passes)
+        matcher = self.get_matcher(engine)
+        if stats is None:
+            stats = ExecuteStats()
+        if trace is not None:
+            trace.begin(varnum)
+        if profile is not None:
+            profile.begin(varnum)
+            matcher = profile.matcher(self, matcher)
+        # a repeat can match any number of tokens before a replacement, so every pass rescans it all
+        incremental = incremental and matcher.bounded
+        if piece_table and not isinstance(tokens, tokens_def.PieceTable):
+            tokens = tokens_def.PieceTable(list(tokens))
+
+        # match on token ids, keeping the tokens themselves alongside for the output
+        ids = self.ingest(tokens)
+        if isinstance(tokens, tokens_def.PieceTable):
+            ids = tokens_def.PieceTable(ids)
+
+        # windows of start indices to scan in this pass, [begin, end)
+        dirty = [(0, len(tokens))]
+        last_pass = None if passes is None else stats.passes + passes
+
         # 2. starting at each token of the input 
-        while True:
+        while len(dirty) > 0:
+            stats.passes += 1
+            stats.positions_full += len(tokens)
+            if profile is not None:
+                profile.start_pass(stats.passes)
+
             modified = False # check if any replacements were made 
+            next_dirty = []
+            offset = 0 # how far replacements in this pass moved the tokens after them
             i = 0 # starting index for the current token 
-            
-            while i < len(tokens): # loop through the tokens 
-                print(f"Starting at token index {i}: {tokens[i]}")
-            
-                # 3. follow down the tree as far as possible, consuming as many tokens as possible 
-                def match_forward(node, token_index, path):
-                    print(f"Attempting match")
-                    if token_index >= len(tokens):
-                        print("Ran out of input tokens")
-                        return path
-                    if tokens[token_index] in node.children:
-                        print(f"Token {tokens[token_index]} matched in {node.children}")
-                        next_node = node.children[tokens[token_index]]
-                        path.append(next_node)
-                        return match_forward(next_node, token_index + 1, path)
-                    if "#" in node.children:
-                        print(f"Token {tokens[token_index]} matched in {node.children} with #")
-                        next_node = node.children["#"]
-                        path.append(next_node)
-                        return match_forward(next_node, token_index + 1, path)
-                    print(f"No matching node in graph {tokens[token_index]}, {node.children}")
-                    return path
-                
-                print("Attempting Match")
-                # start matching/tracking path from head node 
-                path = [self.head]
-                path = match_forward(self.head, i, path)
-            
-                def match_backward(path):
-                    # check if there is a replacement at the current node if not, go back up the graph by 1 node
-                    for node in reversed(path):
-                        if node.replacement:
-                            return node
-                    return None 
-            
-                matched_node = match_backward(path) 
-            
-                if matched_node: 
-                    # determine the start and end of the matched tokens 
-                    j = i + len(path) - 1
-                    print(f"Replacement found: {matched_node.replacement.content}")
-                    
-                    replacement = [x for x in matched_node.replacement.content]
-
-                    # handle internal variables
-                    print("Replacement variables")
-                    print(matched_node.replacement.internal_variables)
-                    varmap = {}
-                    for x in range(len(replacement)):
-                        the_var = matched_node.replacement.internal_variables[x]
-                        print(f"varmap = {varmap}")
-                        print(f"var[{x}] = {the_var}")
-                        if the_var == -1:
-                            continue
-
-                        if the_var not in varmap:
-                            varmap[the_var] = varnum
-                            varnum += 1
-
-                        the_type = replacement[x].type if hasattr(replacement[x], "type") else []
-                        print(f"Replacement type ({replacement[x]}) ({type(replacement[x])}): {the_type}")
-                        replacement[x].token = f"#{varmap[the_var]}"
-                        # replacement[x] = tokens_def.VariableToken(tokens_def.Token("#" + str(varmap[the_var]), "", 0), "", 0, tokens_def.Token("vartoken", "", 0), tokens_def.TypeToken(tokens_def.Token("#TYPE", "", 0), "", 0, the_type))
-
-
-                    # handle external variables
-                    external_varmap = {}
-                    for x in range(len(matched_node.clause.content)):
-                        external_var = matched_node.clause.external_variables[x]
-                        if external_var == -1:
-                            continue
-
-                        if external_var not in external_varmap:
-                            print(f"Added external var ${external_var} = {tokens[i+x]}")
-                            external_varmap[external_var] = tokens[i+x]
-
-
-                    for x in range(len(replacement)):
-                        external_var = matched_node.replacement.external_variables[x]
-                        if external_var == -1:
-                            continue
-
-                        if external_var not in external_varmap:
-                            print(f"Found variable ${external_var} that is not in the original representation... Cannot replace")
-                            return False, varnum
-
-                        replacement[x].token = external_varmap[external_var]
-                        print(f"Replaced external var {external_var} with {replacement[x].token}")
-
-
-                    tokens = tokens[:i] + replacement + tokens[j:]
-                    print(f"Tokens after replacement: {tokens}")
-                    
-                    # move the starting index to after the replacement's end 
-                    i = i + len(replacement)
-                    modified = True 
+
+            for begin, end in dirty:
+                i = max(i, begin + offset)
+                while True:
+                    # 3./4. find the next start index with a replacement
+                    stop = end + offset
+                    match = matcher.find(ids, i, stop) if i < stop else None
+                    if match is None:
+                        stats.positions_scanned += max(0, stop - i)
+                        break
+
                     if not replace:
                         return True, varnum
-                    
-                else: 
-                    print("No replacement found, moving to next token")
-                    i += 1
-                
+
+                    start, length, clause = match
+                    stats.positions_scanned += start - i + 1
+                    replacement, varnum = self.instantiate(clause, tokens[start:start+length], varnum)
+                    if replacement is None:
+                        return False, varnum
+
+                    if trace is not None:
+                        trace.record(stats.passes, start, clause.id, length, len(replacement))
+                    if profile is not None:
+                        profile.record(stats.passes, start, clause.id, length, len(replacement))
+                    tokens = splice(tokens, start, start+length, replacement)
+                    ids = splice(ids, start, start+length, self.ingest(replacement))
+                    stats.rewrites += 1
+
+                    # move the starting index to after the replacement's end 
+                    i = start + len(replacement)
+                    offset += len(replacement) - length
+                    modified = True 
+
+                    # any walk that reads the replacement has to be retried next pass
+                    window_begin = max(0, start - self.max_length + 1)
+                    if len(next_dirty) > 0 and next_dirty[-1][1] >= window_begin:
+                        next_dirty[-1] = (next_dirty[-1][0], i)
+                    else:
+                        next_dirty.append((window_begin, i))
+
             # 5. if there were any replacements made in the list, rerun through the list again (back to step 2)
             if not modified:
-                print("No modifications made in this pass, exiting")
                 break
+            if stats.passes == last_pass:
+                break
+
+            if incremental:
+                dirty = next_dirty
+            else:
+                dirty = [(0, len(tokens))]
 
         if not replace:
             return False, varnum
             
+        if isinstance(tokens, tokens_def.PieceTable):
+            tokens = tokens.to_list()
         return tokens_def.Tokens(tokens), varnum
 
+    def execute_sharded(self, tokens:list, varnum=0, workers:int=None, shards:int=None, engine="trie", incremental=False):
+        """
+        Execute the graph on a long token list by optimizing shards of it in parallel
+        Gives the same output as execute, see parallel.execute_sharded
+        """
+        import parallel
+        return parallel.execute_sharded(self, tokens, varnum, workers, shards, engine, incremental)
 
+    def execute_many(self, inputs, workers:int=None, chunksize:int=None, varnum=0, engine="trie", incremental=False):
+        """
+        Execute the graph on many independent token lists in a process pool sharing this graph
+        Returns a (result, varnum, seconds) for each input in order, see parallel.execute_many
+        """
+        import parallel
+        return parallel.execute_many(self, inputs, workers, chunksize, varnum, engine, incremental)
 
-class Parser:
+    def execute_cached(self, tokens:list, cache, varnum=0, engine="trie", incremental=False):
+        """
+        Execute the graph one { } block at a time, reusing the output of blocks in cache (memo.BlockCache)
+        Gives the same output as execute, see memo.execute_cached
+        """
+        import memo
+        return memo.execute_cached(self, tokens, cache, varnum, engine, incremental)
+
+    def execute_saturated(self, tokens:list, varnum=0, max_nodes:int=None, seconds:float=None, stats=None):
+        """
+        Optimize tokens by equality saturation, applying every clause of a rule in both directions,
+        and take the cheapest sequence found instead of the first fixpoint, see egraph.execute_saturated
+        """
+        import egraph
+        if max_nodes is None:
+            max_nodes = egraph.MAX_NODES
+        if seconds is None:
+            seconds = egraph.SECONDS
+        return egraph.execute_saturated(self, tokens, varnum, max_nodes, seconds, stats)
+
+    def execute_stream(self, tokens, varnum=0, engine="trie", chunk:int=256, lookbehind:int=None):
+        """
+        Execute the graph on any iterable of tokens, yielding output tokens once they are final
+        Each pass of execute runs as a stage behind the one before it,
+        holding about max_length tokens plus the longest replacement.
+        Each pass can rewrite max_length - 1 tokens further back than the pass before it,
+        so lookbehind tokens of output are held back (16 passes' worth by default)
+        and a ValueError is raised if a pass reaches back further.
+        The output matches execute up to the numbers given to internal variables.
+        Returns the final varnum (the value of yield from)
+        """
+        graph = self.snapshot()
+        if lookbehind is None:
+            lookbehind = 16 * max(1, graph.max_length - 1)
+        matcher = graph.get_matcher(engine)
+        if not matcher.bounded:
+            raise ValueError("execute_stream needs every match to fit in max_length tokens, which * repeats do not")
+        state = StreamPass(graph, matcher, varnum, max(lookbehind, graph.max_length - 1))
+        output = []
+        buffer = []
+        for x in tokens:
+            buffer.append(x)
+            if len(buffer) >= chunk:
+                state.feed(buffer, False, output)
+                buffer = []
+                yield from output
+                output.clear()
+
+        state.feed(buffer, True, output)
+        yield from output
+        return state.varnum
+
+
+
+def splice(sequence, start:int, end:int, items:list):
     """
-    Parses a database file to create a graph
-    Requires knowing the metric and direction to optimize with
+    Replace sequence[start:end] with items
+    A PieceTable is changed in place, a list is rebuilt
     """
-    def __init__(self, database_filenames:list[str], direction:int, metric:int):
-        self.database_filenames = database_filenames
-        self.direction = direction
-        self.metric = metric
+    if isinstance(sequence, tokens_def.PieceTable):
+        sequence.replace(start, end, items)
+        return sequence
+    return sequence[:start] + items + sequence[end:]
 
-        file_data = self.parse_files()
-        self.graph = self.parse_file_data(file_data)
 
+class TrieGraph(BaseGraph):
+    """
+    Walk over a trie of Nodes held in memory
+    Edges are labelled with ids from the graph's symbol table
+    """
+    def clause_by_id(self, clause_id:int):
+        return self.clauses[clause_id]
 
-    def parse_files(self):
-        file_data = ""
-        for filename in self.database_filenames:
-            try:
-                with open(filename, 'r') as f:
-                    file_data += f.read()
-                    file_data += "\n"
-            except:
-                print(f"Unable to open {filename}")
-                exit(1)
-        return file_data
+    def token_id(self, string:str):
+        # strings no edge is labelled with all get -1, so inputs do not grow the table
+        return self.symbols.lookup(string)
+
+    def step(self, node:Node, label:int):
+        """
+        Follow the edge for label out of node, falling back to the edge for its type and then the # edge
+        Returns None if there is no edge to follow
+        """
+        children = node.children
+        if type(label) is tuple:
+            label, typed = label
+            if label not in children and typed in children:
+                return children[typed]
+        if label in children:
+            return children[label]
+        if self.hash_id in children:
+            return children[self.hash_id]
+        return None
+
+    def labels(self, node:Node):
+        """
+        Get the labels of the edges out of node
+        """
+        return node.children.keys()
+
+    def clause_at(self, node:Node):
+        """
+        Get the clause matched at node if it has a replacement
+        """
+        if node.replacement:
+            return node.clause
+        return None
 
 
-    def parse_file_data(self, file_data):
-        result = Graph()
+class GraphVersion(TrieGraph):
+    """
+    A version of a Graph's rules that does not change
+    Shares every node the graph has not changed since
+    """
+    def __init__(self, graph):
+        TrieGraph.__init__(self)
+        self.head = graph.head
+        self.symbols = graph.symbols
+        self.hash_id = graph.hash_id
+        self.clauses = graph.clauses
+        self.max_length = graph.max_length
+        self.version = graph.version
 
-        # read through the file data, parsing into clauses
-        current_rule:list[Clause] = []
-        clause_data = []
 
-        all_clauses = []
+class MinimizedGraph(TrieGraph):
+    """
+    A version of a Graph's rules with equal subtrees shared, see minimize_graph
+    Does not change
+    """
+    def __init__(self, graph, head:Node, rewriting:dict):
+        TrieGraph.__init__(self)
+        self.head = head
+        self.symbols = graph.symbols
+        self.hash_id = graph.hash_id
+        self.clauses = graph.clauses
+        self.max_length = graph.max_length
+        self.version = graph.version
+        # merged nodes give one of their clauses, so the rest can not be found by walking
+        self.rewriting = rewriting
 
-        quotes = 0
-        backslashes = 0
+    def rewriting_clauses(self):
+        return dict(self.rewriting)
 
-        i = 0
-        n = len(file_data)
-        while i < n:
-            if file_data[i] == '"':
-                if backslashes % 2 == 0:
-                    quotes ^= 1
-
-                    if quotes == 0:
-                        # we just reached the end of a clause. 
-                        # get the metrics for this clause
-                        the_metric = None
-                        if i + 1 < n and file_data[i+1] == "~":
-                            # get content until =
-                            i += 1
-                            start = i + 1
-                            while i < n and file_data[i] not in ["=", ";"]:
-                                i += 1
-                            content = file_data[start:i]
-                            content = content.split(":")
-
-                            try:
-                                the_metric = float(content[self.metric])
-                            except:
-                                if self.direction > 0:
-                                    the_metric = -math.inf
-                                else:
-                                    the_metric = math.inf
-                            i -= 1
-
-                        print(the_metric)
-
-                        # add it to the current rule
-                        new_clause = Clause()
-                        new_clause.content = [x for x in "".join(clause_data).split(" ") if len(x) > 0]
-                        new_clause.metric = the_metric
-                        current_rule.append(new_clause)
-                        clause_data = []
-                    else:
-                        i += 1
-                        continue
-            elif file_data[i] == "\\":
-                backslashes += 1
-            elif file_data[i] == ";":
-                if quotes == 0:
-                    # we just reached the end of a rule. handle all clauses of this rule
-                    if len(current_rule) > 0:
-                        best = current_rule[0]
-                        for clause in current_rule:
-                            if self.direction > 0:
-                                if clause.metric > best.metric:
-                                    best = clause
-                            else:
-                                if clause.metric < best.metric:
-                                    best = clause
-
-                        for clause in current_rule:
-                            if clause != best:
-                                clause.replacement = best
-                            else:
-                                clause.replacement = None
-                        all_clauses += current_rule
-
-                    current_rule = []
-            if file_data[i] != "\\":
-                backslashes = 0
-
-            if quotes == 1:
-                if file_data[i] == "\\" and backslashes % 2 == 1:
-                    i += 1
+
+# a possible cycle is only taken out if a run on one of its contents is still rewriting after this many passes,
+# or has grown past LOOP_TOKENS tokens
+LOOP_PASSES = 32
+LOOP_TOKENS = 256
+# passes run at a time, between which a run's size is checked
+LOOP_STEP = 4
+# how many ways to fill in the # of a content are run, see Graph.loops
+LOOP_SEEDS = 4
+
+
+class Graph(TrieGraph):
+    """
+    Graph of nodes held in memory
+    Rules can be added and removed while the graph is in use.
+    execute runs on a snapshot, and nodes a snapshot holds are copied before they are changed
+    """
+    def __init__(self):
+        TrieGraph.__init__(self)
+        self.head = Node()
+        self.symbols = tokens_def.SymbolTable()
+        self.hash_id = self.symbols.intern("#")
+        # every clause added and every replacement, by id
+        self.clauses = []
+        # groups of clauses left out for rewriting each other forever
+        self.cycles = []
+        # the group in cycles of each clause left out
+        self.rejected = {}
+        # groups of clauses that could rewrite each other forever but never did when run, kept in the graph
+        self.suspected = []
+        # contents of every clause in the trie
+        self.index = ContentIndex()
+        # clauses of the rules added with add_rule, by rule id
+        self.rules = {}
+        self.next_rule = 0
+        # number of clauses with replacements in the graph of each content length
+        self.lengths = {}
+        # nodes of older versions belong to snapshots
+        self.version = 0
+        self.current = None
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["current"] = None
+        state["matchers"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def snapshot(self):
+        """
+        Get the current version of the graph, which later changes leave alone
+        """
+        with self.lock:
+            if self.current is None:
+                self.current = GraphVersion(self)
+                # every node made so far now belongs to the snapshot
+                self.version += 1
+            return self.current
+
+    def changed(self):
+        # matchers and the snapshot built for the old graph are stale
+        self.matchers = {}
+        self.current = None
+
+    def register(self, clause:Clause):
+        """
+        Give clause and its replacement ids in this graph's clause table
+        """
+        while clause is not None and clause.id < 0:
+            clause.id = len(self.clauses)
+            self.clauses.append(clause)
+            clause = clause.replacement
+
+    def add_rule(self, clauses:list[Clause]):
+        """
+        Add one rule, its clauses given replacements by prepare_rule, to the graph in use
+        Clauses that would rewrite each other forever are left out as in add_clauses
+        Returns the rule id to give remove_rule
+        """
+        return self.add_rules([clauses])[0]
+
+    def add_rules(self, rules:list[list[Clause]]):
+        """
+        Add several rules at once, see add_rule
+        """
+        with self.lock:
+            rule_ids = []
+            all_clauses = []
+            for clauses in rules:
+                rule_ids.append(self.next_rule)
+                self.rules[self.next_rule] = list(clauses)
+                self.next_rule += 1
+                all_clauses += clauses
+            self.admit(all_clauses)
+        return rule_ids
+
+    def remove_rule(self, rule_id:int):
+        """
+        Take a rule added with add_rule out of the graph, pruning the nodes no other clause uses
+        Clauses left out for a cycle through the rule are checked again
+        and added if they no longer form one, as are the clauses matched in place of the rule's
+        """
+        with self.lock:
+            rule = self.rules.pop(rule_id)
+            rule_set = set(rule)
+            freed = {}
+            following = []
+            for clause in rule:
+                group = self.rejected.pop(clause, None)
+                if group is None:
+                    self.delete(clause)
+                    following.append(self.index.remove(clause))
                     continue
+                self.cycles = [x for x in self.cycles if x is not group]
+                for x in group:
+                    if x not in rule:
+                        freed[x.id] = x
+            self.suspected = [x for x in self.suspected if rule_set.isdisjoint(x)]
+
+            # what is left of a broken cycle can still form a smaller one
+            freed = [freed[x] for x in sorted(freed)]
+            for clause in freed:
+                del self.rejected[clause]
+            self.admit(freed, [x for x in following if x is not None and x not in rule])
+
+    def add_clauses(self, clauses:list[Clause]):
+        """
+        Add clause objects to the graph, leaving out every rule involved in a cycle
+        """
+        with self.lock:
+            self.admit(clauses)
+
+    def add_clause(self, clause:Clause):
+        """
+        Add a clause object to the graph
+        Does not check for circular rules, use add_clauses for that
+        """
+        with self.lock:
+            self.register(clause)
+            self.index.add(clause)
+            self.insert(clause)
+            self.changed()
+
+    def admit(self, clauses:list[Clause], following:list[Clause]=()):
+        """
+        Add clauses to the graph, leaving out every clause in a cycle.
+        A cycle the new clauses close takes the clauses already in the graph on it out too,
+        and following are clauses in the graph newly matched in place of others, checked along with them
+        """
+        for clause in clauses:
+            self.register(clause)
+            self.index.add(clause)
+            self.insert(clause)
+        self.changed()
+
+        # a new cycle has to go through a new clause or one matched in place of a clause taken out,
+        # so only the walks from them are needed
+        starts = [x for x in clauses if x.replacement is not None] + list(following)
+        following = []
+        # clauses whose contents were run, which taking clauses out cannot make loop
+        checked = set()
+        for cycle in cyclic_components(starts, self.index.matches):
+            for looping in self.loops(cycle, checked):
+                following += self.reject(looping)
+            kept = [x for x in cycle if x not in self.rejected]
+            if len(kept) > 0:
+                debug.dbg(f"[Circular Check] Keeping possibly circular rules that never looped when run: {[x.content for x in kept]}")
+                self.suspected = [x for x in self.suspected if set(kept).isdisjoint(x)]
+                self.suspected.append(kept)
+
+        # a clause matched in place of one taken out is only run, its cycles are the ones just checked
+        while len(following) > 0:
+            clause = following.pop()
+            if clause is None or clause in self.rejected:
+                continue
+            for looping in self.loops([clause], checked):
+                following += self.reject(looping)
+
+    def reject(self, looping:list[Clause]):
+        """
+        Take clauses found rewriting forever out of the graph
+        Returns the clauses matched in their place
+        """
+        debug.dbg(f"[Circular Check] Detected circular rules: {[x.content for x in looping]}")
+        debug.dbg(f"[Circular Check] Not adding clauses to graph: {[x.content for x in looping]}")
+        following = []
+        for clause in looping:
+            self.delete(clause)
+            self.rejected[clause] = looping
+            following.append(self.index.remove(clause))
+        self.cycles.append(looping)
+        self.changed()
+        return following
+
+    def loops(self, cycle:list[Clause], checked:set):
+        """
+        Run the graph on the content of each clause of cycle not in checked that does not shrink the tokens,
+        adding it to checked,
+        its # filled in with a token no literal edge takes, then each token of the clause and of the rest of cycle
+        Yields the clauses that made replacements in the last pass of each run that did not end, by id,
+        which are to be taken out before the next run as they would keep it from ending too
+        """
+        import parallel
+        tokens = (str(x) for clause in cycle for x in clause.content + clause.replacement.content)
+        # only the first LOOP_SEEDS tokens of a pool are tried
+        others = list(itertools.islice(unique(x for x in tokens if x != "#"), LOOP_SEEDS))
+        for clause in cycle:
+            # a loop goes through a clause that does not shrink the tokens, whose content starts it
+            if clause in checked or shrinks(clause):
+                continue
+            checked.add(clause)
+            content = [str(x) for x in clause.content]
+            holes = [x for x, token in enumerate(content) if token == "#"]
+            own = [str(x) for x in clause.replacement.content] + content
+            # #0 takes the # edges, like the internal variables execute makes
+            pool = unique(x for x in itertools.chain(["#0"], own, others) if x != "#")
+            pool = itertools.islice(pool, LOOP_SEEDS) if len(holes) > 0 else [None]
+            for fill in pool:
+                for x in holes:
+                    content[x] = fill
+                # a few passes at a time, so a run that keeps growing is stopped before it gets large
+                run = list(content)
+                varnum = 0
+                for k in range(LOOP_STEP, LOOP_PASSES + 1, LOOP_STEP):
+                    log = parallel.EventLog()
+                    stats = ExecuteStats()
+                    run, varnum = self.execute(run, varnum=varnum, stats=stats, trace=log, passes=LOOP_STEP)
+                    if run is False or len(log.events) == 0 or log.events[-1][0] < stats.passes:
+                        # the last pass made no replacement, so the run has ended
+                        break
+                    if k == LOOP_PASSES or len(run) > LOOP_TOKENS:
+                        yield [self.clauses[x] for x in sorted(set(x[2] for x in log.events if x[0] == stats.passes))]
+                        break
+
+    def writable(self, node:Node):
+        """
+        Get a node that can be changed in place of node, copying it if a snapshot holds it
+        """
+        if node.version == self.version:
+            return node
+        result = Node(node.replacement, node.clause)
+        result.children = dict(node.children)
+        result.count = node.count
+        # ending lists are replaced rather than changed, so they can be shared
+        result.ending = node.ending
+        result.version = self.version
+        return result
 
-                clause_data += file_data[i]
+    def set_ending(self, node:Node, ending:list[Clause]):
+        # the clause added first wins when several have the same content
+        ending = sorted(ending, key=lambda x: x.id)
+        node.ending = ending if len(ending) > 0 else None
+        node.clause = ending[0] if len(ending) > 0 else None
+        node.replacement = node.clause.replacement if node.clause is not None else None
 
+    def insert(self, clause:Clause):
+        """
+        Add the path for clause to the trie
+        """
+        ids = [self.symbols.intern(edge_string(x)) for x in clause.content]
+        # the automaton engine matches the literals of pattern tokens like a* by id
+        for x in clause.content:
+            literal = pattern_element(str(x))[0]
+            if literal is not None:
+                self.symbols.intern(literal)
+        node = self.head = self.writable(self.head)
+        for label in ids:
+            child = node.children.get(label)
+            if child is None:
+                child = Node()
+                child.version = self.version
+            else:
+                child = self.writable(child)
+            child.count += 1
+            node.children[label] = child
+            node = child
+
+        if clause.replacement is not None and len(ids) > 0:
+            clause.template = Template(clause)
+            self.set_ending(node, (node.ending or []) + [clause])
+            self.lengths[len(ids)] = self.lengths.get(len(ids), 0) + 1
+            self.max_length = max(self.max_length, len(ids))
+
+    def delete(self, clause:Clause):
+        """
+        Take the path for clause out of the trie, pruning nodes no other clause passes through
+        """
+        ids = [self.symbols.lookup(edge_string(x)) for x in clause.content]
+        path = [self.writable(self.head)]
+        self.head = path[0]
+        for label in ids:
+            child = self.writable(path[-1].children[label])
+            path[-1].children[label] = child
+            path.append(child)
+
+        if clause.replacement is not None and len(ids) > 0:
+            self.set_ending(path[-1], [x for x in path[-1].ending if x is not clause])
+            self.lengths[len(ids)] -= 1
+            if self.lengths[len(ids)] == 0:
+                del self.lengths[len(ids)]
+                self.max_length = max(self.lengths, default=0)
+
+        for depth in range(len(ids), 0, -1):
+            path[depth].count -= 1
+            if path[depth].count == 0:
+                del path[depth-1].children[ids[depth-1]]
+
+
+class MinimizeStats:
+    """
+    Size of a graph before and after minimize_graph
+    """
+    def __init__(self):
+        self.nodes_before = 0
+        self.nodes_after = 0
+        self.edges_before = 0
+        self.edges_after = 0
+        # bytes of the nodes and their edge dicts
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def __repr__(self):
+        return (f"MinimizeStats(nodes={self.nodes_before}->{self.nodes_after}, edges={self.edges_before}->{self.edges_after}, "
+                f"bytes={self.bytes_before}->{self.bytes_after})")
+
+
+def payload_key(node:Node):
+    """
+    Get what a match ending at node gives, the same for nodes whose clauses make the same replacement from a match:
+    the same replacement clause, content length and $n positions, without repeats to align
+    """
+    if not node.replacement:
+        return None
+    clause = node.clause
+    template = clause.template if clause.template is not None else Template(clause)
+    if template.aligns:
+        return ("clause", id(clause))
+    return ("replacement", id(clause.replacement), len(clause.content), tuple(clause.external_variables))
+
+
+def graph_size(head:Node):
+    """
+    Count the nodes and edges reachable from head and the bytes they take
+    """
+    nodes = edges = size = 0
+    seen = set()
+    stack = [head]
+    while len(stack) > 0:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        nodes += 1
+        edges += len(node.children)
+        size += sys.getsizeof(node) + sys.getsizeof(node.children)
+        stack += node.children.values()
+    return nodes, edges, size
+
+
+def minimize_graph(graph:BaseGraph, stats:MinimizeStats=None):
+    """
+    Get a MinimizedGraph that matches like graph, its trie made a directed acyclic word graph.
+    Nodes are merged when their edges lead to merged nodes and a match ending at them gives the same (see payload_key).
+    A subtree with no clause in it becomes one shared leaf, a walk into it can not match whatever it reads next,
+    and the edge into it is kept so the edges for types and # are not taken in its place
+    """
+    graph = graph.snapshot()
+    if stats is None:
+        stats = MinimizeStats()
+    stats.nodes_before, stats.edges_before, stats.bytes_before = graph_size(graph.head)
+
+    dead = Node()
+    # node standing for each node of graph by id, and each merged node by its key
+    merged = {}
+    unique = {}
+    # children are merged before their parents
+    stack = [(graph.head, False)]
+    while len(stack) > 0:
+        node, expanded = stack.pop()
+        if id(node) in merged:
+            continue
+        if not expanded:
+            stack.append((node, True))
+            stack += [(child, False) for child in node.children.values() if id(child) not in merged]
+            continue
 
+        children = {label: merged[id(child)] for label, child in node.children.items()}
+        payload = payload_key(node)
+        if payload is None and all(child is dead for child in children.values()):
+            merged[id(node)] = dead
+            continue
+        key = (payload, tuple(sorted((label, id(child)) for label, child in children.items())))
+        if key not in unique:
+            result = Node(node.replacement, node.clause)
+            result.children = children
+            result.ending = node.ending
+            unique[key] = result
+        merged[id(node)] = unique[key]
+
+    result = MinimizedGraph(graph, merged[id(graph.head)], graph.rewriting_clauses())
+    stats.nodes_after, stats.edges_after, stats.bytes_after = graph_size(result.head)
+    return result
+
+
+class IndexNode:
+    """
+    A node of a ContentIndex
+    As a dependency it stands for every clause matched at or below it
+    """
+    __slots__ = ("children", "clauses", "ending", "count")
+
+    def __init__(self, clauses:list=None):
+        self.children = {}
+        # clauses with replacements whose content ends here, by id
+        self.clauses = [] if clauses is None else clauses
+        # an IndexNode sharing the clauses without the children, standing for just them
+        self.ending = None
+        # number of contents passing through here
+        self.count = 0
+
+    def dependencies(self):
+        # only the first clause is matched, see Graph.set_ending
+        return self.clauses[:1] + list(self.children.values())
+
+
+class ContentIndex:
+    """
+    Trie over the contents of the clauses in a graph,
+    for finding every clause that could match inside or across a replacement
+    """
+    def __init__(self):
+        self.root = IndexNode()
+        # by edge label, the nodes below the first token of a content the edge leads to,
+        # where a match that started before a replacement is when it reaches it
+        # each is an IndexNode holding them as its children, standing for every clause below them
+        self.inner = {}
+        # the same for the nodes below the second token of a content, by the labels of the two edges into them
+        self.pairs = {}
+        # by edge label, an IndexNode holding the endings of the nodes of more than one token its edge leads to
+        self.ends = {}
+        # IndexNodes standing for all of inner and all of ends, for a token that can be anything
+        self.every_inner = IndexNode()
+        self.every_inner.children = self.inner
+        self.every_end = IndexNode()
+        self.every_end.children = self.ends
+        # the IndexNodes made by matches, by the choices of the replacement, until the contents change
+        self.found = {}
+
+    def add(self, clause:Clause):
+        """
+        Add the content of clause
+        A clause without a replacement is never matched but its path still decides which edges tokens take
+        """
+        if len(clause.content) == 0:
+            return
+        self.found = {}
+        content = [edge_string(x) for x in clause.content]
+        node = self.root
+        for depth, x in enumerate(content):
+            child = node.children.get(x)
+            if child is None:
+                child = node.children[x] = IndexNode()
+                if depth > 0:
+                    self.inner.setdefault(x, IndexNode()).children[id(child)] = child
+                if depth > 1:
+                    self.pairs.setdefault((content[depth-1], x), IndexNode()).children[id(child)] = child
+            child.count += 1
+            node = child
+        if clause.replacement is None:
+            return
+        node.clauses.append(clause)
+        node.clauses.sort(key=lambda x: x.id)
+        if node.ending is None:
+            node.ending = IndexNode(node.clauses)
+        if len(content) > 1:
+            self.ends.setdefault(content[-1], IndexNode()).children[id(node)] = node.ending
+
+    def remove(self, clause:Clause):
+        """
+        Take the content of clause out
+        Returns the clause matched in its place when it was matched and shares its content with another, else None
+        """
+        if len(clause.content) == 0:
+            return None
+        self.found = {}
+        path = [self.root]
+        content = [edge_string(x) for x in clause.content]
+        for x in content:
+            path.append(path[-1].children[x])
+        node = path[-1]
+        following = None
+        if clause.replacement is not None:
+            matched = node.clauses[0] is clause
+            node.clauses.remove(clause)
+            if len(node.clauses) > 0:
+                following = node.clauses[0] if matched else None
+            elif len(content) > 1:
+                ends = self.ends[content[-1]]
+                del ends.children[id(node)]
+                if len(ends.children) == 0:
+                    del self.ends[content[-1]]
+        for depth in range(len(content), 0, -1):
+            path[depth].count -= 1
+            if path[depth].count > 0:
+                continue
+            del path[depth-1].children[content[depth-1]]
+            if depth > 1:
+                inner = self.inner[content[depth-1]]
+                del inner.children[id(path[depth])]
+                if len(inner.children) == 0:
+                    del self.inner[content[depth-1]]
+            if depth > 2:
+                pair = (content[depth-2], content[depth-1])
+                del self.pairs[pair].children[id(path[depth])]
+                if len(self.pairs[pair].children) == 0:
+                    del self.pairs[pair]
+        return following
+
+    def labels(self, x:str):
+        """
+        Get the edge labels a replacement token x can match
+        """
+        return ["#"] if x == "#" else [x, "#"]
+
+    def choices(self, clause:Clause):
+        """
+        Get the token each token of the replacement of clause is, None for one that can be any token
+        A token bound to a $n is the token its variable matched,
+        which can only be something else when the variable is on a wildcard
+        """
+        sources = {}
+        for x, the_var in enumerate(clause.external_variables):
+            if the_var != -1 and the_var not in sources:
+                sources[the_var] = pattern_element(str(clause.content[x]))[0]
+        # clauses made by hand may not have their variables filled in
+        variables = clause.replacement.external_variables
+        result = []
+        for x, token in enumerate(clause.replacement.content):
+            if x < len(variables) and variables[x] != -1:
+                result.append(sources.get(variables[x]))
+            else:
+                result.append(edge_string(token))
+        return result
+
+    def walk(self, nodes, choices:list, targets:list):
+        """
+        Follow the tokens in choices from nodes, adding the clauses they match to targets
+        A token takes its own edge or else the # edge, like Graph.step, and one that can be any token takes every edge
+        Reaching the end of choices matches everything below, as the tokens after it can be anything,
+        so the nodes reached are added as dependencies standing for their subtrees
+        """
+        for x, token in enumerate(choices):
+            if token is None and x == len(choices) - 1:
+                # the children of nodes are every node a last token that can be anything reaches
+                targets += nodes
+                return
+            # by id, in the order they are reached so the analysis is the same every run
+            following = {}
+            for node in nodes:
+                if token is None:
+                    following.update((id(x), x) for x in node.children.values())
+                    continue
+                child = node.children.get(token)
+                if child is None:
+                    child = node.children.get("#")
+                if child is not None:
+                    following[id(child)] = child
+            if len(following) == 0:
+                return
+            nodes = list(following.values())
+            targets += [node.ending for node in nodes if len(node.clauses) > 0]
+        targets += nodes
+
+    def matches(self, clause:Clause):
+        """
+        Get an IndexNode standing for every clause that could match inside the replacement of clause,
+        or overlapping it with tokens on either side
+        Clauses whose replacements can be the same tokens share the IndexNode, so its clauses are walked once
+        """
+        if clause.replacement is None or len(clause.replacement.content) == 0:
+            return []
+        choices = tuple(self.choices(clause))
+        node = self.found.get(choices)
+        if node is None:
+            node = self.found[choices] = IndexNode()
+            node.children = {id(x): x for x in self.targets(choices)}
+        return [node]
+
+    def targets(self, choices:tuple):
+        """
+        Get every clause that could match inside replacement tokens that can be choices, see choices,
+        or overlapping them with tokens on either side
+        Wildcards follow every path so no possible match is missed
+        Includes IndexNodes standing for every clause below them
+        """
+        targets = []
+        for start in range(len(choices)):
+            self.walk([self.root], choices[start:], targets)
+
+        # a match that started before the replacement has already taken a token and is anywhere below the root
+        # which of a token's edges it takes there depends on the node, so both are followed
+        first = choices[0]
+        if len(choices) == 1:
+            if first is None:
+                targets.append(self.every_inner)
+            else:
+                targets += [self.inner[x] for x in self.labels(first) if x in self.inner]
+            return targets
+        if first is None:
+            targets.append(self.every_end)
+        else:
+            targets += [self.ends[x] for x in self.labels(first) if x in self.ends]
+        second = choices[1]
+        if first is None and second is None:
+            targets.append(self.every_inner)
+            return targets
+        if first is None:
+            # these also hold the nodes of matches starting at the replacement, which are found twice
+            nodes = [node for y in self.labels(second) if y in self.inner for node in self.inner[y].children.values()]
+            targets += [node.ending for node in nodes if len(node.clauses) > 0]
+            self.walk(nodes, choices[2:], targets)
+            return targets
+        if second is None:
+            nodes = [node for x in self.labels(first) if x in self.inner for node in self.inner[x].children.values()]
+            self.walk(nodes, choices[1:], targets)
+            return targets
+        # the walk takes its first two steps at once
+        pairs = [(x, y) for x in self.labels(first) for y in self.labels(second)]
+        nodes = [node for x in pairs if x in self.pairs for node in self.pairs[x].children.values()]
+        targets += [node.ending for node in nodes if len(node.clauses) > 0]
+        self.walk(nodes, choices[2:], targets)
+        return targets
+
+
+def unique(items):
+    """
+    Yield each item the first time it comes up
+    """
+    seen = set()
+    for x in items:
+        if x not in seen:
+            seen.add(x)
+            yield x
+
+
+def shrinks(clause:Clause):
+    """
+    Whether a rewrite by clause always leaves fewer tokens than it took
+    """
+    if any(pattern_element(str(x))[1] for x in clause.content):
+        return False
+    return len(clause.replacement.content) < len(clause.content)
+
+
+def cyclic_components(starts:list[Clause], edges):
+    """
+    Get the strongly connected components with a cycle among the clauses reachable from starts,
+    where edges(clause) gives the clauses clause depends on
+    Edges can also lead to IndexNodes, whose dependencies() are every clause below them,
+    they are left out of the components
+    A component whose clauses all shrink the tokens is left out, as its rewrites always end
+    """
+    # tarjan's algorithm, iterative so long chains do not hit the recursion limit
+    targets_of = {}
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+
+    def visit(clause):
+        index[clause] = lowlink[clause] = len(index)
+        stack.append(clause)
+        on_stack.add(clause)
+        if isinstance(clause, IndexNode):
+            targets_of[clause] = clause.dependencies()
+        else:
+            targets_of[clause] = edges(clause)
+        return (clause, iter(targets_of[clause]))
+
+    for root_clause in starts:
+        if root_clause in index:
+            continue
+        work = [visit(root_clause)]
+        while len(work) > 0:
+            clause, targets = work[-1]
+            target = next(targets, None)
+            if target is not None:
+                if target not in index:
+                    work.append(visit(target))
+                elif target in on_stack:
+                    lowlink[clause] = min(lowlink[clause], index[target])
+                continue
+
+            work.pop()
+            if len(work) > 0:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[clause])
+            if lowlink[clause] == index[clause]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member)
+                    component.append(member)
+                    if member is clause:
+                        break
+                if len(component) > 1 or clause in targets_of[clause]:
+                    component = [x for x in component if isinstance(x, Clause)]
+                    component.reverse()
+                    # clauses that all take tokens away run out of tokens to rewrite
+                    if not all(shrinks(x) for x in component):
+                        cycles.append(component)
+    return cycles
+
+
+def find_cycles(clauses:list[Clause]):
+    """
+    Find the rules that can keep rewriting each other's replacements forever.
+    A clause depends on every clause whose content can match inside its replacement
+    or overlapping it, found by walking a trie of all contents over the replacement
+    Returns the strongly connected components of those dependencies that contain a cycle
+    """
+    index = ContentIndex()
+    for clause in clauses:
+        index.add(clause)
+    return cyclic_components([x for x in clauses if x.replacement is not None], index.matches)
+
+
+class StreamPass:
+    """
+    One pass of Graph.execute_stream over the tokens the pass before it gives out
+    The next pass is only made once this one replaces something.
+    The first pass also keeps the run's varnum and the tail of the output
+    that is held back in case a pass made later has to rescan it
+    """
+    def __init__(self, graph:BaseGraph, matcher, varnum:int, lookbehind:int, first=None):
+        self.graph = graph
+        self.matcher = matcher
+        self.first = self if first is None else first
+        self.varnum = varnum
+        self.lookbehind = lookbehind
+        self.tokens = []
+        self.ids = []
+        self.next = None
+        # tokens given to the next pass, or to the output tail by the last pass
+        self.given = []
+        self.tail = []
+        self.emitted = 0
+
+    def feed(self, tokens:list, final:bool, output:list):
+        """
+        Run every pass as far as the buffered tokens allow, adding final tokens to output
+        final means no more tokens will come
+        """
+        stage = self
+        while True:
+            tokens = stage.scan(tokens, final)
+            if stage.next is None:
+                break
+            stage = stage.next
+
+        # the last pass gives the output, minus the tail a new pass could rescan
+        self.tail += tokens
+        keep = 0 if final else self.lookbehind
+        if len(self.tail) > keep:
+            count = len(self.tail) - keep
+            output += self.tail[:count]
+            del self.tail[:count]
+            self.emitted += count
+
+    def scan(self, tokens:list, final:bool):
+        """
+        Scan as far as the buffered tokens allow
+        Returns the tokens this pass gives out
+        """
+        self.tokens += tokens
+        self.ids += self.graph.ingest(tokens)
+
+        # a start index is only decided once the longest clause fits after it
+        stop = len(self.ids) if final else len(self.ids) - self.graph.max_length + 1
+        i = 0
+        while i < stop:
+            match = self.matcher.find(self.ids, i, stop)
+            if match is None:
+                self.give(self.tokens[i:stop])
+                i = stop
+                break
+
+            start, length, clause = match
+            self.give(self.tokens[i:start])
+            replacement, self.first.varnum = self.graph.instantiate(clause, self.tokens[start:start+length], self.first.varnum)
+            if replacement is None:
+                raise ValueError(f"Unable to make the replacement for {clause.content}")
+            if self.next is None:
+                self.start_next()
+            self.give(replacement)
+            i = start + length
+
+        del self.tokens[:i]
+        del self.ids[:i]
+
+        given = self.given
+        self.given = []
+        return given
+
+    def start_next(self):
+        """
+        Make the pass after this one, starting where a walk could read this pass's first replacement
+        """
+        first = self.first
+        first.tail += self.given
+        self.given = []
+        rescan = self.graph.max_length - 1
+        if len(first.tail) < rescan and first.emitted > 0:
+            raise ValueError(f"A replacement reaches back past the {first.lookbehind} tokens held for it, raise lookbehind")
+        rescan = min(rescan, len(first.tail))
+        self.next = StreamPass(self.graph, self.matcher, 0, 0, first)
+        # the next pass takes the tail as its input and gives it out again
+        self.given = first.tail[len(first.tail) - rescan:]
+        del first.tail[len(first.tail) - rescan:]
+
+    def give(self, tokens:list):
+        self.given += tokens
+
+
+class ExecuteStats:
+    """
+    Counters filled in by Graph.execute
+    """
+    def __init__(self):
+        self.passes = 0
+        self.rewrites = 0
+        # start indices the scan covered
+        self.positions_scanned = 0
+        # start indices full passes over the whole list would cover
+        self.positions_full = 0
+
+    def __repr__(self):
+        return f"ExecuteStats(passes={self.passes}, rewrites={self.rewrites}, positions_scanned={self.positions_scanned}, positions_full={self.positions_full})"
+
+
+class TrieMatcher:
+    """
+    Finds matches by restarting a walk from the head
+    of the graph at every start index
+    """
+    # no match is longer than the graph's max_length
+    bounded = True
+    # matches are the walks of BaseGraph.step, which parallel checks shard edges with
+    follows_trie = True
+
+    def __init__(self, graph:BaseGraph):
+        self.graph = graph
+
+    def walk(self, tokens, i):
+        """
+        Get the nodes of the walk starting at i, the head first
+        """
+        # 3. follow down the tree as far as possible, consuming as many tokens as possible 
+        path = [self.graph.head]
+        node = self.graph.head
+        k = i
+        while k < len(tokens):
+            node = self.graph.step(node, tokens[k])
+            if node is None:
+                break
+            path.append(node)
+            k += 1
+        return path
+
+    def match_at(self, tokens, i):
+        """
+        Get the deepest clause with a replacement on the walk starting at i
+        Returns (length, clause) or None
+        """
+        path = self.walk(tokens, i)
+
+        # 4. go back up the graph until there is a replacement at the current node
+        for depth in range(len(path)-1, 0, -1):
+            clause = self.graph.clause_at(path[depth])
+            if clause is not None:
+                return depth, clause
+        return None
+
+    def find(self, tokens, start:int, stop:int=None):
+        """
+        Find the first start index in [start, stop) that has a match
+        tokens are the ids from BaseGraph.ingest
+        Returns (index, length, clause) or None
+        """
+        if stop is None:
+            stop = len(tokens)
+        i = start
+        while i < stop:
+            match = self.match_at(tokens, i)
+            if match is not None:
+                return i, match[0], match[1]
             i += 1
+        return None
 
-        # handle type awareness
-        for clause in all_clauses:
-            for i in range(len(clause.content)):
-                if "#" in clause.content[i]:
-                    if "(" in clause.content[i]:
-                        typeval = ""
-                        paren_index = clause.content[i].index("(")
-                        type_toks = clause.content[i][paren_index+1:]
-                        clause.content[i] = clause.content[i][:paren_index]
-                        for tok in type_toks:
-                            typeval += tok
-                    else:
-                        typeval = ""
-                    new_token = tokens_def.VariableToken(clause.content[i], "", 0, "vartoken", tokens_def.TypeToken(tokens_def.Token("#TYPE", "", 0), "", 0, [tokens_def.Token(f"{typeval}", "", 0)]))
-                else:
-                    new_token = tokens_def.Token(clause.content[i], "", 0)
-                print("Made type aware token")
-                clause.content[i] = new_token
-
-
-        #handle external variables
-        for clause in all_clauses:
-            for i in range(len(clause.content)):
-                if "$" in clause.content[i]:
-                    dollar_index = clause.content[i].token.index("$")
-                    clause.external_variables.append(int(clause.content[i][dollar_index+1:]))
-                    clause.content[i].token = clause.content[i].token[:dollar_index]
-                else:
-                    clause.external_variables.append(-1)
 
+class ScanState:
+    """
+    A state of the Aho-Corasick automaton.
+    Holds every walk down the graph that is still alive,
+    as (depth, node) pairs from the deepest (leftmost) to the shallowest
+    """
+    def __init__(self, walks:tuple, fail, graph:BaseGraph):
+        self.walks = walks
+        # failure link: the same state without the deepest walk
+        self.fail = fail
+        # edge labels that lead somewhere from this state (a new walk always starts at head)
+        # any other token takes the shared transition stored under None
+        if len(walks) > 0:
+            self.labels = set(graph.labels(walks[0][1])) | fail.labels
+        else:
+            self.labels = set(graph.labels(graph.head))
+        self.transitions = {}
+        # the deepest walk with a replacement
+        self.output = None
+        for depth, node in walks:
+            clause = graph.clause_at(node)
+            if clause is not None:
+                self.output = (depth, clause)
+                break
 
-        # handle internal variables
-        for clause in all_clauses:
-            for i in range(len(clause.content)):
-                if "#" in clause.content[i]:
-                    clause.internal_variables.append(int(clause.content[i][1:]))
-                    clause.content[i].token = "#"
-                else:
-                    clause.internal_variables.append(-1)
 
+class AhoCorasickMatcher:
+    """
+    Finds matches in one left-to-right scan of the input.
+    Each state of the scan is the set of walks still alive,
+    so leftmost-deepest matches are the same as TrieMatcher's.
+    States and transitions are built lazily through failure links
+    """
+    bounded = True
+    follows_trie = True
 
-        print(all_clauses)
-        for clause in all_clauses:
-            print(clause.content)
+    def __init__(self, graph:BaseGraph):
+        self.graph = graph
+        self.states = {}
+        self.root = self.get_state(())
+
+    def get_state(self, walks:tuple):
+        if walks not in self.states:
+            fail = self.get_state(walks[1:]) if len(walks) > 0 else None
+            self.states[walks] = ScanState(walks, fail, self.graph)
+        return self.states[walks]
+
+    def step(self, state:ScanState, label:int):
+        """
+        Follow the transition out of state on a token id
+        """
 
-        print("Adding all clauses")
-        for clause in all_clauses:
-            result.add_clause(clause)
+        # go down the failure links until a transition is known
+        pending = []
+        current = state
+        typed = type(label) is tuple
+        while True:
+            if label in current.labels:
+                key = label
+            elif typed and (label[0] in current.labels or label[1] in current.labels):
+                # a typed variable leads somewhere if its id or its type's edge does
+                key = label
+            else:
+                key = None
+            if key in current.transitions:
+                result = current.transitions[key]
+                break
+            if len(current.walks) == 0:
+                # a new walk starting at this token
+                result = self.get_state(self.advance(0, self.graph.head, label))
+                current.transitions[key] = result
+                break
+            pending.append((current, key))
+            current = current.fail
 
+        # extend each state by its deepest walk
+        for current, key in reversed(pending):
+            depth, node = current.walks[0]
+            result = self.get_state(self.advance(depth, node, label) + result.walks)
+            current.transitions[key] = result
         return result
 
+    def advance(self, depth:int, node, label:int):
+        node = self.graph.step(node, label)
+        if node is None:
+            return ()
+        return ((depth + 1, node),)
+
+    def find(self, tokens, start:int, stop:int=None):
+        """
+        Find the first start index in [start, stop) that has a match
+        tokens are the ids from BaseGraph.ingest
+        Returns (index, length, clause) or None
+        """
+        if stop is None:
+            stop = len(tokens)
+        if start >= stop:
+            return None
+
+        best = None
+        state = self.root
+        k = start
+        n = len(tokens)
+        while k < n:
+            state = self.step(state, tokens[k])
+            if state.output is not None:
+                depth, clause = state.output
+                begin = k - depth + 1
+                if begin < stop and (best is None or begin < best[0] or (begin == best[0] and depth > best[1])):
+                    best = (begin, depth, clause)
+
+            # the leftmost walk still alive
+            earliest = k - state.walks[0][0] + 1 if len(state.walks) > 0 else k + 1
+            if best is not None and earliest > best[0]:
+                return best
+            if best is None and earliest >= stop:
+                return None
+            k += 1
+
+        return best
+
+
+def pattern_element(token:str):
+    """
+    Read a clause token as an element of a pattern for the automaton engine
+    Returns (the literal it matches or None for any token, whether it repeats)
+    # and . match any token and a * suffix repeats a token 0 or more times.
+    A lone * is a literal, and so are \\. and a \\* suffix
+    """
+    repeat = len(token) > 1 and token.endswith("*") and not token.endswith("\\*")
+    if repeat:
+        token = token[:-1]
+    if token == "#" or token == ".":
+        return None, repeat
+    if len(token) > 1 and token[0] == "\\" and token[1:] in (".", "*"):
+        token = token[1:]
+    elif token.endswith("\\*"):
+        token = token[:-2] + "*"
+    return token, repeat
+
+
+def align(content:list, matched:list):
+    """
+    Get the token each element of content (see pattern_element) matched,
+    the first of its run for a repeat and None for a repeat that matched nothing
+    Repeats take as many tokens as they can. Returns None if content cannot match matched
+    """
+    elements = [pattern_element(str(x)) for x in content]
+    strings = [str(x) for x in matched]
+    n = len(elements)
+    m = len(strings)
+
+    # fits[p][k]: elements[p:] can match strings[k:]
+    fits = [[False] * (m + 1) for p in range(n + 1)]
+    fits[n][m] = True
+    for p in range(n - 1, -1, -1):
+        literal, repeat = elements[p]
+        for k in range(m, -1, -1):
+            one = k < m and (literal is None or literal == strings[k])
+            if repeat:
+                fits[p][k] = fits[p+1][k] or (one and fits[p][k+1])
+            else:
+                fits[p][k] = one and fits[p+1][k+1]
+    if not fits[0][0]:
+        return None
+
+    result = []
+    k = 0
+    for p, (literal, repeat) in enumerate(elements):
+        if not repeat:
+            result.append(matched[k])
+            k += 1
+            continue
+        first = k
+        while k < m and (literal is None or literal == strings[k]) and fits[p][k+1]:
+            k += 1
+        result.append(matched[first] if k > first else None)
+    return result
+
+
+class AutomatonMatcher:
+    """
+    Finds matches by running every clause as a pattern (see pattern_element) in one scan.
+    The clauses are compiled into an NFA whose states are (clause, next element),
+    and the sets of live states the scan reaches are built lazily as DFA states.
+    Each live state keeps the earliest index it was reached from,
+    so nothing is ever retried and a scan is linear in the input.
+    Unlike the trie, a # edge is still followed when a literal edge fails later,
+    so a clause is found whenever it matches.
+    The match is the longest at the leftmost index with one,
+    preferring the clause with literals earliest, then typed variables, then the clause added first
+    """
+    # stands for a walk starting at the current token, for every clause at once
+    START = (-1, 0)
+    # DFA states kept before the cache is dropped and built again
+    MAX_STATES = 10000
+    follows_trie = False
+
+    def __init__(self, graph:BaseGraph):
+        self.graph = graph
+
+        # every clause with a replacement in the graph
+        clauses = graph.rewriting_clauses()
+
+        self.clauses = []
+        self.patterns = []
+        self.literals = set()
+        ranked = []
+        for clause in clauses.values():
+            pattern = []
+            kinds = []
+            for x in clause.content:
+                literal, repeat = pattern_element(str(x))
+                # a typed variable only matches variables of its type, by the id of its edge
+                typed = graph.token_id(edge_string(x)) if literal is None and edge_string(x) != str(x) else None
+                if literal is not None:
+                    # a literal the graph has no id for matches nothing
+                    literal = graph.token_id(literal)
+                    literal = literal if literal >= 0 else -2
+                    self.literals.add(literal)
+                pattern.append((literal, repeat, typed))
+                kinds.append(0 if literal is not None else 1 if typed is not None else 2)
+            ranked.append((kinds, clause.id, clause, pattern))
+        # a clause's index is its priority
+        for kinds, clause_id, clause, pattern in sorted(ranked, key=lambda x: (x[0], x[1])):
+            self.clauses.append(clause)
+            self.patterns.append(tuple(pattern))
+
+        # without repeats no match is longer than max_length
+        self.bounded = not any(repeat for pattern in self.patterns for literal, repeat, typed in pattern)
+        self.reset()
+
+    def reset(self):
+        self.state_ids = {}
+        self.states = []
+        self.transitions = []
+        self.start_steps = {}
+        self.empty = self.get_state(())
+
+    def get_state(self, threads:tuple):
+        if threads not in self.state_ids:
+            self.state_ids[threads] = len(self.states)
+            self.states.append(threads)
+            # label -> (state, index of the thread each new thread came from, (thread, clause) of each match)
+            # None -> the state with a walk starting here, and "prefix", n -> the first n threads
+            self.transitions.append({})
+        return self.state_ids[threads]
+
+    def closure(self, c:int, p:int):
+        """
+        Get the states reached from (c, p) without reading a token: repeats can be skipped
+        """
+        result = [(c, p)]
+        pattern = self.patterns[c]
+        while p < len(pattern) and pattern[p][1]:
+            p += 1
+            result.append((c, p))
+        return result
+
+    def advance(self, thread:tuple, label:int):
+        c, p = thread
+        pattern = self.patterns[c]
+        if p == len(pattern):
+            return []
+        literal, repeat, typed = pattern[p]
+        label, label_type = label if type(label) is tuple else (label, None)
+        if literal is not None and literal != label:
+            return []
+        if typed is not None and typed != label_type:
+            return []
+        return self.closure(c, p if repeat else p + 1)
+
+    def start_step(self, label:int):
+        """
+        Get the states a walk starting at a token with this label is in after it
+        """
+        if label not in self.start_steps:
+            result = []
+            for c in range(len(self.patterns)):
+                for thread in self.closure(c, 0):
+                    result += self.advance(thread, label)
+            self.start_steps[label] = result
+        return self.start_steps[label]
+
+    def step(self, state:int, label:int):
+        transitions = self.transitions[state]
+        if label in transitions:
+            return transitions[label]
+
+        threads = []
+        index = {}
+        sources = []
+        matches = []
+        for k, thread in enumerate(self.states[state]):
+            following = self.start_step(label) if thread == self.START else self.advance(thread, label)
+            for new in following:
+                # the thread from the earliest start is kept, the others can only match later
+                if new in index:
+                    continue
+                index[new] = len(threads)
+                threads.append(new)
+                sources.append(k)
+                if new[1] == len(self.patterns[new[0]]):
+                    matches.append((len(threads) - 1, new[0]))
+
+        result = (self.get_state(tuple(threads)), tuple(sources), tuple(matches))
+        transitions[label] = result
+        return result
+
+    def with_start(self, state:int):
+        transitions = self.transitions[state]
+        if None not in transitions:
+            threads = self.states[state]
+            transitions[None] = self.get_state(threads + (self.START,)) if self.START not in threads else state
+        return transitions[None]
+
+    def prefix(self, state:int, count:int):
+        transitions = self.transitions[state]
+        key = ("prefix", count)
+        if key not in transitions:
+            transitions[key] = self.get_state(self.states[state][:count])
+        return transitions[key]
+
+    def find(self, tokens, start:int, stop:int=None):
+        """
+        Find the first start index in [start, stop) that has a match
+        tokens are the ids from BaseGraph.ingest
+        Returns (index, length, clause) or None
+        """
+        if stop is None:
+            stop = len(tokens)
+        if len(self.states) > self.MAX_STATES:
+            self.reset()
+
+        # (start, end, priority) of the best match so far
+        best = None
+        state = self.empty
+        starts = []
+        k = start
+        n = len(tokens)
+        while True:
+            if best is None and k < stop:
+                if self.START not in self.states[state]:
+                    state = self.with_start(state)
+                    starts = starts + [k]
+                else:
+                    # the walk from an earlier start is already in every state this one would be
+                    pass
+            if len(starts) == 0 or k >= n:
+                break
+
+            label = tokens[k]
+            if type(label) is tuple:
+                label = (label[0] if label[0] in self.literals else -1, label[1])
+            elif label not in self.literals:
+                label = -1
+            state, sources, matches = self.step(state, label)
+            starts = [starts[s] for s in sources]
+            k += 1
+
+            for thread, priority in matches:
+                begin = starts[thread]
+                if best is None or begin < best[0] or (begin == best[0] and (k > best[1] or (k == best[1] and priority < best[2]))):
+                    best = (begin, k, priority)
+
+            if best is not None:
+                # walks from after the best match's start can not win
+                keep = 0
+                while keep < len(starts) and starts[keep] <= best[0]:
+                    keep += 1
+                if keep < len(starts):
+                    state = self.prefix(state, keep)
+                    starts = starts[:keep]
+
+        if best is None:
+            return None
+        return best[0], best[1] - best[0], self.clauses[best[2]]
+
+
+ENGINES = {
+    "trie": TrieMatcher,
+    "aho-corasick": AhoCorasickMatcher,
+    "automaton": AutomatonMatcher,
+}
+
+
+
+# outside a clause only quotes and ; matter, and a backslash can only escape a quote
+OUTSIDE = re.compile(rb'(?:[^"\\;]+|\\[\\"]|\\(?![\\"]))*')
+# the text of a clause up to its closing quote, where a backslash escapes any character
+CLAUSE_TEXT = re.compile(rb'(?:[^"\\]+|\\.)*', re.S)
+ESCAPE = re.compile(rb'\\(.)', re.S)
+# the metrics after a clause run until the next = or ;
+METRICS = re.compile(rb'~([^=;]*)')
+
+
+def decode_text(data:bytes):
+    # files used to be read in text mode, so keep its newline handling
+    return data.decode().replace("\r\n", "\n").replace("\r", "\n")
+
+
+def lex_rules(data, filename:str, metric:int, direction:int):
+    """
+    Scan database data (bytes or a memory map) in one pass
+    Yields (line number, clauses) for every rule ending in ;
+    Each clause has its content split into strings and the metric selected by metric
+    A rule of one clause needs no metric, as it is never compared
+    """
+    rule = []
+    # line of each clause of the rule without metrics
+    missing = []
+    rule_line = 0
+    line = 1
+    counted = 0
+    position = 0
+    n = len(data)
+    while True:
+        position = OUTSIDE.match(data, position).end()
+        if position >= n:
+            break
+
+        if data[position:position+1] == b";":
+            if len(rule) == 1 and len(missing) > 0:
+                rule[0].metric = -math.inf if direction > 0 else math.inf
+            else:
+                for clause, clause_line in missing:
+                    errors.ERROR_HANDLER.add_error(errors.Error(f"Clause {clause.content} has no metrics", filename, clause_line))
+            if len(rule) > 0:
+                yield rule_line, rule
+            rule = []
+            missing = []
+            position += 1
+            continue
+
+        # an opening quote
+        line += data[counted:position].count(b"\n")
+        counted = position
+        text = CLAUSE_TEXT.match(data, position + 1)
+        if text.end() >= n:
+            errors.ERROR_HANDLER.add_error(errors.Error("Clause is missing its closing quote", filename, line), fatal=False)
+            return
+        position = text.end() + 1
+
+        clause = Clause()
+        text = text.group()
+        if b"\\" in text:
+            text = ESCAPE.sub(rb"\1", text)
+        clause.content = [x for x in decode_text(text).split(" ") if len(x) > 0]
+        clause.metric = None
+
+        metrics = METRICS.match(data, position)
+        if metrics is not None:
+            values = decode_text(metrics.group(1)).split(":")
+            try:
+                clause.metric = float(values[metric])
+            except (IndexError, ValueError):
+                clause.metric = -math.inf if direction > 0 else math.inf
+            position = metrics.end()
+        else:
+            missing.append((clause, line))
+
+        if len(rule) == 0:
+            rule_line = line
+        rule.append(clause)
+
+    if len(rule) > 0:
+        errors.ERROR_HANDLER.add_error(errors.Error("Rule is missing its ;", filename, rule_line), fatal=False)
+
+
+def prepare_clause(clause:Clause):
+    """
+    Turn the content strings of a lexed clause into tokens,
+    taking out the types of # variables and the $n and #n variable numbers
+    """
+    # a * suffix repeating a variable is put back once it is read, a typed variable's * is part of its type
+    repeats = []
+    for i in range(len(clause.content)):
+        x = clause.content[i]
+        repeat = ("#" in x or "$" in x) and "(" not in x and pattern_element(x)[1]
+        if repeat:
+            clause.content[i] = x[:-1]
+        repeats.append(repeat)
+
+    # handle type awareness
+    for i in range(len(clause.content)):
+        if "#" in clause.content[i]:
+            if "(" in clause.content[i]:
+                typeval = ""
+                paren_index = clause.content[i].index("(")
+                type_toks = clause.content[i][paren_index+1:]
+                clause.content[i] = clause.content[i][:paren_index]
+                # #1(int$2 binds $2 like #1$2 does
+                if "$" in type_toks:
+                    clause.content[i] += type_toks[type_toks.index("$"):]
+                    type_toks = type_toks[:type_toks.index("$")]
+                for tok in type_toks:
+                    typeval += tok
+            else:
+                typeval = ""
+            new_token = tokens_def.VariableToken(clause.content[i], "", 0, "vartoken", tokens_def.TypeToken(tokens_def.Token("#TYPE", "", 0), "", 0, [tokens_def.Token(f"{typeval}", "", 0)]))
+        else:
+            new_token = tokens_def.Token(clause.content[i], "", 0)
+        clause.content[i] = new_token
+
+    #handle external variables
+    for i in range(len(clause.content)):
+        if "$" in clause.content[i]:
+            dollar_index = clause.content[i].token.index("$")
+            clause.external_variables.append(int(clause.content[i][dollar_index+1:]))
+            clause.content[i].token = clause.content[i].token[:dollar_index]
+        else:
+            clause.external_variables.append(-1)
+
+    # handle internal variables
+    for i in range(len(clause.content)):
+        if "#" in clause.content[i]:
+            clause.internal_variables.append(int(clause.content[i][1:]))
+            clause.content[i].token = "#"
+        else:
+            clause.internal_variables.append(-1)
+
+    for i in range(len(clause.content)):
+        if repeats[i]:
+            clause.content[i].token += "*"
+
+
+def prepare_rule(rule:list[Clause], direction:int):
+    """
+    Get a lexed rule ready for Graph.add_rule
+    The best clause by metric is what the others are replaced with
+    """
+    best = rule[0]
+    for clause in rule:
+        if direction > 0:
+            if clause.metric > best.metric:
+                best = clause
+        else:
+            if clause.metric < best.metric:
+                best = clause
+
+    for clause in rule:
+        if clause != best:
+            clause.replacement = best
+        else:
+            clause.replacement = None
+        prepare_clause(clause)
+    return rule
+
+
+def read_database(filename:str, metric:int, direction:int):
+    """
+    Lex a database file through a memory map
+    Yields (line number, clauses) for every rule
+    """
+    try:
+        f = open(filename, 'rb')
+    except OSError:
+        errors.ERROR_HANDLER.add_error(errors.Error(f"Unable to open {filename}", filename, 0))
+        return
+
+    with f:
+        # an empty file cannot be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from lex_rules(data, filename, metric, direction)
+
+
+def build_graph(rules, direction:int):
+    """
+    Build a graph from lexed rules, (filename, line number, clauses) like Parser.read_rules yields
+    """
+    result = Graph()
+    all_rules = [prepare_rule(rule, direction) for filename, line, rule in rules]
+
+    result.add_rules(all_rules)
+
+    return result
+
+
+class Parser:
+    """
+    Parses a database file to create a graph
+    Requires knowing the metric and direction to optimize with
+    """
+    def __init__(self, database_filenames:list[str], direction:int, metric:int, minimize:bool=False):
+        self.database_filenames = database_filenames
+        self.direction = direction
+        self.metric = metric
+
+        self.graph = self.build_graph(self.read_rules())
+        # a minimized graph matches the same but its rules can not be changed
+        self.minimize_stats = None
+        if minimize:
+            self.minimize_stats = MinimizeStats()
+            self.graph = minimize_graph(self.graph, self.minimize_stats)
+
+
+    def read_rules(self):
+        """
+        Lex every database file
+        Yields (filename, line number, clauses) for every rule
+        """
+        for filename in self.database_filenames:
+            for line, rule in read_database(filename, self.metric, self.direction):
+                yield filename, line, rule
+
+
+    def parse_file_data(self, file_data:str):
+        """
+        Build a graph from database text
+        """
+        rules = lex_rules(file_data.encode(), "", self.metric, self.direction)
+        return self.build_graph(("", line, rule) for line, rule in rules)
+
+
+    def build_graph(self, rules):
+        return build_graph(rules, self.direction)
+
 
 if __name__ == "__main__":
     parser = Parser(["c.rbe"], -1, 2)
@@ -388,6 +2037,61 @@ if __name__ == "__main__":
     circular_rule = Clause()
     circular_rule.content = ["a", "b", "c"]
     circular_rule.replacement = circular_rule 
-    parser.graph.add_clause(circular_rule)
+    parser.graph.add_clauses([circular_rule])
     print("Tokens after adding circular rule: ", result)
 
+    # a token bound to a $n can be any token, "k k" is rewritten to "k k"
+    print("\nChecking for circular rule through a bound token...")
+    parser = Parser([], -1, 0)
+    graph = parser.parse_file_data('"k #1$1"~5 = "x$1 x$1"~1;')
+    assert len(graph.cycles) == 1, graph.cycles
+    print("Tokens after execution: ", graph.execute(["k", "k"])[0])
+
+    # "z a" becomes "z b a", whose "b a" becomes "a c", and "z" with the new "a" matches again
+    print("\nChecking for circular rules overlapping a replacement...")
+    graph = parser.parse_file_data('"b a"~6 = "a c"~0; "z a"~6 = "z b a"~0;')
+    assert len(graph.cycles) == 1, graph.cycles
+    print("Tokens after execution: ", graph.execute(["z", "a"])[0])
+    # "a z" becomes "a b z", whose "a b" becomes "c a", and the new "a" with "z" matches again
+    graph = parser.parse_file_data('"a b"~6 = "c a"~0; "a z"~6 = "a b z"~0;')
+    assert len(graph.cycles) == 1, graph.cycles
+    print("Tokens after execution: ", graph.execute(["a", "z"])[0])
+
+    # rules that always take tokens away end even when they match their own replacements
+    print("\nChecking shrinking rules are not circular...")
+    for data, tokens, expected in [('"x a"~5 = "a"~1;', ["x", "x", "x", "a"], ["a"]),
+                                   ('"- - #1$1"~5 = "x$1"~1;', ["-", "-", "-", "-", "y"], ["y"]),
+                                   ('"( #1$1 )"~5 = "x$1"~1;', ["(", "(", "y", ")", ")"], ["y"])]:
+        graph = parser.parse_file_data(data)
+        assert len(graph.cycles) == 0, graph.cycles
+        result = [str(x) for x in graph.execute(tokens)[0]]
+        assert result == expected, result
+        print("Tokens after execution: ", result)
+
+    # an internal variable is named the same every time its clause is built, so the search runs out of rewrites
+    print("\nChecking equality saturation saturates with internal variables...")
+    graph = parser.parse_file_data('"p q"~5 = "r #1"~1;')
+    import egraph
+    stats = egraph.SaturationStats()
+    result, varnum = graph.execute_saturated(["p", "q", "p", "q"], stats=stats)
+    assert stats.saturated, stats
+    assert [str(x) for x in result] == ["r", "#0", "r", "#1"], result
+    print("Tokens after execution: ", [str(x) for x in result], stats)
+
+    # "b c" becomes "d", which starts a match of "a d" with the token before it, and so on leftward
+    print("\nChecking execute_stream gives what execute does...")
+    graph = parser.parse_file_data('"b c"~5 = "d"~1; "a d"~5 = "d"~1;')
+    tokens = ["x"] * 20 + ["a"] * 3 + ["b", "c"] + ["y"] * 20
+    expected = [str(x) for x in graph.execute(list(tokens))[0]]
+    assert expected == ["x"] * 20 + ["d"] + ["y"] * 20, expected
+    for engine in ["trie", "aho-corasick"]:
+        result = [str(x) for x in graph.execute_stream(iter(tokens), engine=engine, chunk=8, lookbehind=4)]
+        assert result == expected, result
+    # a cascade reaching back further than the tokens held for it cannot be rewritten any more
+    tokens = ["x"] * 20 + ["a"] * 20 + ["b", "c"] + ["y"] * 20
+    try:
+        list(graph.execute_stream(iter(tokens), chunk=8, lookbehind=4))
+        assert False, "execute_stream gave tokens a later pass rewrites"
+    except ValueError as e:
+        print("Stream stopped: ", e)
+    print("Tokens after execution: ", expected)
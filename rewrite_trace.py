@@ -0,0 +1,147 @@
+
+import struct
+import sys
+
+import rba_v2
+
+
+MAGIC = b"RBAT"
+FORMAT_VERSION = 1
+
+# magic, version, starting varnum
+HEADER = struct.Struct("<4sIq")
+# pass number, position, clause id, match length, replacement length
+EVENT = struct.Struct("<IIiII")
+
+
+class Trace:
+    """
+    Records the replacements Graph.execute makes as fixed-size events
+    in a preallocated ring buffer.
+    With a filename, the buffer is flushed to the file before it wraps
+    so the whole run is kept. Without one, only the last capacity events are kept
+    """
+    def __init__(self, capacity:int=65536, filename:str=None):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * EVENT.size)
+        self.filename = filename
+        self.file = None
+        self.varnum = 0
+        # events recorded, and how many of those are in the file
+        self.count = 0
+        self.flushed = 0
+
+    def begin(self, varnum:int):
+        """
+        Start a new run whose first internal variable is varnum
+        """
+        self.varnum = varnum
+        self.count = 0
+        self.flushed = 0
+        if self.filename is not None:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.filename, 'wb')
+            self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, varnum))
+
+    def record(self, pass_number:int, position:int, clause_id:int, match_length:int, replacement_length:int):
+        slot = self.count % self.capacity
+        EVENT.pack_into(self.buffer, slot * EVENT.size, pass_number, position, clause_id, match_length, replacement_length)
+        self.count += 1
+        if self.file is not None and self.count - self.flushed == self.capacity:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the events not yet in the file
+        """
+        if self.file is None:
+            return
+        while self.flushed < self.count:
+            slot = self.flushed % self.capacity
+            end = min(self.capacity, slot + self.count - self.flushed)
+            self.file.write(self.buffer[slot * EVENT.size:end * EVENT.size])
+            self.flushed += end - slot
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def lost(self):
+        """
+        Get the number of events overwritten without being written to a file
+        """
+        if self.filename is not None:
+            return 0
+        return max(0, self.count - self.capacity)
+
+    def events(self):
+        """
+        Get the events of the run, oldest first
+        """
+        if self.filename is not None:
+            self.flush()
+            return read_trace(self.filename)[1]
+        if self.lost() > 0:
+            raise ValueError(f"The trace buffer wrapped and lost {self.lost()} events. Give the trace a filename to keep them")
+        return [EVENT.unpack_from(self.buffer, slot * EVENT.size) for slot in range(self.count)]
+
+
+def read_trace(filename:str):
+    """
+    Read a trace file
+    Returns (starting varnum, events)
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, varnum = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a trace file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{filename} has trace version {version}, expected {FORMAT_VERSION}")
+    events = [x for x in EVENT.iter_unpack(data[HEADER.size:len(data) - (len(data) - HEADER.size) % EVENT.size])]
+    return varnum, events
+
+
+def replay(graph:rba_v2.BaseGraph, tokens:list, events:list, varnum:int=0):
+    """
+    Rebuild the token states of a run from its input and trace without matching.
+    Yields (event, tokens) after each replacement
+    """
+    tokens = list(tokens)
+    for event in events:
+        pass_number, position, clause_id, match_length, replacement_length = event
+        clause = graph.clause_by_id(clause_id)
+        if match_length != len(clause.content) or position + match_length > len(tokens):
+            raise ValueError(f"Trace event {event} does not fit the input")
+
+        replacement, varnum = graph.instantiate(clause, tokens[position:position+match_length], varnum)
+        if replacement is None or len(replacement) != replacement_length:
+            raise ValueError(f"Trace event {event} does not match the graph")
+
+        tokens = tokens[:position] + replacement + tokens[position+match_length:]
+        yield event, tokens
+
+
+def replay_trace(graph:rba_v2.BaseGraph, tokens:list, trace:Trace):
+    return replay(graph, tokens, trace.events(), trace.varnum)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 6:
+        print(f"Usage: {sys.argv[0]} <trace> <input> <direction> <metric> <database>...")
+        print("The input holds the tokens execute was given, separated by whitespace")
+        exit(1)
+
+    varnum, events = read_trace(sys.argv[1])
+    with open(sys.argv[2], 'r') as f:
+        tokens = f.read().split()
+    parser = rba_v2.Parser(sys.argv[5:], int(sys.argv[3]), int(sys.argv[4]))
+
+    print(f"input: {' '.join(tokens)}")
+    for event, state in replay(parser.graph, tokens, events, varnum):
+        pass_number, position, clause_id, match_length, replacement_length = event
+        print(f"pass {pass_number} at {position}, clause {clause_id} ({match_length} -> {replacement_length}): {' '.join(str(x) for x in state)}")
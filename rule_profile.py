@@ -0,0 +1,289 @@
+
+import sys
+import time
+
+import rba_v2
+
+
+class ClauseProfile:
+    """
+    Work Graph.execute spent on one clause
+    """
+    def __init__(self, clause:rba_v2.Clause):
+        self.clause = clause
+        # walks from the head charged to the clause, and the depths they reached
+        self.attempts = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.rewrites = 0
+        # tokens matched by its rewrites and tokens put in their place
+        self.consumed = 0
+        self.produced = 0
+        self.walk_seconds = 0.0
+        # building and splicing in the replacement
+        self.rewrite_seconds = 0.0
+
+    def mean_depth(self):
+        return self.depth_total / self.attempts if self.attempts > 0 else 0.0
+
+    def seconds(self):
+        return self.walk_seconds + self.rewrite_seconds
+
+
+class PassProfile:
+    """
+    Totals of one pass number over every run
+    """
+    def __init__(self, number:int):
+        self.number = number
+        self.walks = 0
+        self.rewrites = 0
+        self.consumed = 0
+        self.produced = 0
+        self.seconds = 0.0
+
+
+class ProfileMatcher(rba_v2.TrieMatcher):
+    """
+    Finds the matches TrieMatcher does, charging each walk to a clause of the profile
+    """
+    def __init__(self, graph:rba_v2.BaseGraph, profile):
+        super().__init__(graph)
+        self.profile = profile
+        # clause below each node for walks that end there without a match
+        self.nearest = {}
+
+    def nearest_clause(self, node):
+        """
+        Get the first clause with a replacement at or below node, the one a walk ending there came closest to
+        """
+        if node in self.nearest:
+            return self.nearest[node]
+        result = None
+        stack = [node]
+        while len(stack) > 0 and result is None:
+            current = stack.pop()
+            result = self.graph.clause_at(current)
+            stack += [self.graph.step(current, label) for label in reversed(list(self.graph.labels(current)))]
+        self.nearest[node] = result
+        return result
+
+    def walk(self, tokens, i):
+        self.start = time.perf_counter()
+        self.path = super().walk(tokens, i)
+        return self.path
+
+    def match_at(self, tokens, i):
+        profile = self.profile
+        match = super().match_at(tokens, i)
+        path = self.path
+
+        clause = match[1] if match is not None else None
+        if clause is None and len(path) > 1:
+            clause = self.nearest_clause(path[-1])
+        seconds = time.perf_counter() - self.start
+
+        profile.current.walks += 1
+        profile.current.seconds += seconds
+        if clause is None:
+            profile.head_misses += 1
+            profile.head_seconds += seconds
+            profile.add_stack(None, "walk", seconds)
+            return match
+
+        entry = profile.entry(clause)
+        entry.attempts += 1
+        entry.depth_total += len(path) - 1
+        entry.depth_max = max(entry.depth_max, len(path) - 1)
+        entry.walk_seconds += seconds
+        profile.add_stack(clause, "walk", seconds)
+        return match
+
+    def find(self, tokens, start:int, stop:int=None):
+        self.profile.charge_rewrite()
+        found = super().find(tokens, start, stop)
+        if found is not None:
+            # the time until the next find goes to making the replacement
+            self.profile.pending = (found[2], time.perf_counter())
+        return found
+
+
+class ScanProfileMatcher:
+    """
+    Finds the matches of another engine's matcher, which has no walks from the head,
+    charging each find to the clause it matched as one attempt as deep as the match
+    """
+    def __init__(self, graph:rba_v2.BaseGraph, profile, matcher):
+        self.graph = graph
+        self.profile = profile
+        self.matcher = matcher
+        self.bounded = matcher.bounded
+        self.follows_trie = matcher.follows_trie
+
+    def find(self, tokens, start:int, stop:int=None):
+        profile = self.profile
+        profile.charge_rewrite()
+        begin = time.perf_counter()
+        match = self.matcher.find(tokens, start, stop)
+        seconds = time.perf_counter() - begin
+
+        profile.current.walks += 1
+        profile.current.seconds += seconds
+        if match is None:
+            profile.head_misses += 1
+            profile.head_seconds += seconds
+            profile.add_stack(None, "walk", seconds)
+            return match
+
+        i, length, clause = match
+        entry = profile.entry(clause)
+        entry.attempts += 1
+        entry.depth_total += length
+        entry.depth_max = max(entry.depth_max, length)
+        entry.walk_seconds += seconds
+        profile.add_stack(clause, "walk", seconds)
+        profile.pending = (clause, time.perf_counter())
+        return match
+
+
+class RuleProfile:
+    """
+    Per-clause counters for Graph.execute(tokens, profile=RuleProfile()).
+    Every walk from the head is charged to the clause it matched,
+    or if it matched nothing to the first clause below the deepest node it reached (via Node.clause).
+    Engines other than trie are not walked, so each search they make counts as one walk
+    charged to the clause it found, or to the head if it found nothing.
+    Counters add up over every run the profile is given to
+    """
+    def __init__(self):
+        # ClauseProfile by clause id
+        self.clauses = {}
+        # PassProfile by pass number
+        self.passes = {}
+        # passes each run took to reach a fixpoint
+        self.run_passes = []
+        # walks that could not leave the head
+        self.head_misses = 0
+        self.head_seconds = 0.0
+        # seconds by (pass number, clause id or -1 for the head, walk or rewrite), for collapsed stacks
+        self.stacks = {}
+        # the matcher of the last run and the engine's matcher it stands in for
+        self.last_matcher = None
+        self.last_engine = None
+        self.current = None
+        self.pending = None
+
+    def begin(self, varnum:int):
+        self.run_passes.append(0)
+        self.pending = None
+
+    def matcher(self, graph:rba_v2.BaseGraph, matcher):
+        """
+        Get the matcher execute uses on graph while profiling, in place of the engine's matcher
+        """
+        if self.last_matcher is None or self.last_matcher.graph is not graph or self.last_engine is not matcher:
+            if isinstance(matcher, rba_v2.TrieMatcher):
+                self.last_matcher = ProfileMatcher(graph, self)
+            else:
+                self.last_matcher = ScanProfileMatcher(graph, self, matcher)
+            self.last_engine = matcher
+        return self.last_matcher
+
+    def start_pass(self, number:int):
+        self.charge_rewrite()
+        if number not in self.passes:
+            self.passes[number] = PassProfile(number)
+        self.current = self.passes[number]
+        self.run_passes[-1] = number
+
+    def record(self, pass_number:int, position:int, clause_id:int, match_length:int, replacement_length:int):
+        entry = self.clauses[clause_id]
+        entry.rewrites += 1
+        entry.consumed += match_length
+        entry.produced += replacement_length
+        self.current.rewrites += 1
+        self.current.consumed += match_length
+        self.current.produced += replacement_length
+
+    def entry(self, clause:rba_v2.Clause):
+        if clause.id not in self.clauses:
+            self.clauses[clause.id] = ClauseProfile(clause)
+        return self.clauses[clause.id]
+
+    def add_stack(self, clause:rba_v2.Clause, kind:str, seconds:float):
+        key = (self.current.number, -1 if clause is None else clause.id, kind)
+        self.stacks[key] = self.stacks.get(key, 0.0) + seconds
+
+    def charge_rewrite(self):
+        if self.pending is None:
+            return
+        clause, start = self.pending
+        self.pending = None
+        seconds = time.perf_counter() - start
+        self.entry(clause).rewrite_seconds += seconds
+        self.current.seconds += seconds
+        self.add_stack(clause, "rewrite", seconds)
+
+    def report(self, sort:str="seconds", limit:int=None):
+        """
+        Get a table of the clauses, most first by the sort column:
+        seconds, walk_seconds, rewrite_seconds, attempts, mean_depth, depth_max, rewrites, consumed or produced
+        """
+        def key(entry):
+            value = getattr(entry, sort)
+            return value() if callable(value) else value
+
+        entries = sorted(self.clauses.values(), key=key, reverse=True)
+        if limit is not None:
+            entries = entries[:limit]
+        lines = [f"{'clause':>7} {'attempts':>9} {'depth':>6} {'max':>4} {'rewrites':>9} {'consumed':>9} {'produced':>9} {'walk ms':>9} {'rewrite ms':>10}  rule"]
+        for entry in entries:
+            lines.append(f"{entry.clause.id:>7} {entry.attempts:>9} {entry.mean_depth():>6.2f} {entry.depth_max:>4} "
+                         f"{entry.rewrites:>9} {entry.consumed:>9} {entry.produced:>9} "
+                         f"{entry.walk_seconds*1000:>9.2f} {entry.rewrite_seconds*1000:>10.2f}  {clause_text(entry.clause)}")
+        lines.append(f"head misses: {self.head_misses} ({self.head_seconds*1000:.2f} ms)")
+        for number in sorted(self.passes):
+            totals = self.passes[number]
+            lines.append(f"pass {number}: {totals.walks} walks, {totals.rewrites} rewrites, "
+                         f"{totals.consumed} -> {totals.produced} tokens, {totals.seconds*1000:.2f} ms")
+        if len(self.run_passes) > 0:
+            lines.append(f"passes to fixpoint: {', '.join(str(x) for x in self.run_passes)}")
+        return "\n".join(lines)
+
+    def collapsed(self):
+        """
+        Get the profile as collapsed stacks (execute;pass;clause;walk or rewrite, then microseconds)
+        as flamegraph.pl, speedscope and inferno read them
+        """
+        lines = []
+        for (number, clause_id, kind), seconds in sorted(self.stacks.items()):
+            microseconds = round(seconds * 1000000)
+            if microseconds == 0:
+                continue
+            frame = "head" if clause_id < 0 else f"clause {clause_id} {clause_text(self.clauses[clause_id].clause)}"
+            # ; separates frames, so the ; tokens of a rule are written as a fullwidth semicolon
+            frame = frame.replace(";", "；")
+            lines.append(f"execute;pass {number};{frame};{kind} {microseconds}")
+        return "\n".join(lines) + "\n"
+
+
+def clause_text(clause:rba_v2.Clause):
+    replacement = " ".join(str(x) for x in clause.replacement.content) if clause.replacement is not None else ""
+    return f"{' '.join(str(x) for x in clause.content)} -> {replacement}"
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 6:
+        print(f"Usage: {sys.argv[0]} <input> <collapsed output> <direction> <metric> <database>...")
+        print("The input holds tokens separated by whitespace")
+        exit(1)
+
+    with open(sys.argv[1], 'r') as f:
+        tokens = f.read().split()
+    parser = rba_v2.Parser(sys.argv[5:], int(sys.argv[3]), int(sys.argv[4]))
+
+    profile = RuleProfile()
+    parser.graph.execute(tokens, profile=profile)
+    print(profile.report())
+    with open(sys.argv[2], 'w') as f:
+        f.write(profile.collapsed())
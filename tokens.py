@@ -1,4 +1,7 @@
 
+import contextlib
+import random
+
 import errors
 
 VARNUM = 0
@@ -8,6 +11,8 @@ class Token:
     Holds state information to do with
     a single C token.
     """
+    __slots__ = ("token", "filename", "line_number", "undefined")
+
     def __init__(self, token:str, filename:str, line_number:int):
         self.token = token
         self.filename = filename
@@ -44,16 +49,29 @@ class Token:
     def __hash__(self):
         return self.token.__hash__()
 
+    def __getstate__(self):
+        # slots from every class in the hierarchy, so all pickle protocols work
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
 
     def error(self, message:str):
-        message = f"{message}: ({self.token})"
-        result = errors.Error(message, self.filename, self.line_number)
-        errors.ERROR_HANDLER.add_error(result, fatal=False)
+        errors.ERROR_HANDLER.add_error(self.make_error(message), fatal=False)
 
     def fatal_error(self, message:str):
+        errors.ERROR_HANDLER.add_error(self.make_error(message), fatal=True)
+
+    def make_error(self, message:str):
         message = f"{message}: ({self.token})"
-        result = errors.Error(message, self.filename, self.line_number)
-        errors.ERROR_HANDLER.add_error(result, fatal=True)
+        return errors.Error(message, self.filename, self.line_number)
 
 
 def string_to_token(string):
@@ -75,6 +93,41 @@ class Tokens:
         self.tokens = tokens
         self.varnum = 0
         self.label_num = 0
+        # bracket queries use a BracketIndex once bracket_index() has been called
+        self.indexed = False
+        # the index, or None until the next query rebuilds it
+        self.brackets = None
+
+    def bracket_index(self):
+        """
+        Get the BracketIndex of the tokens, building it if it is missing.
+        From the first call on, get_match_end, get_match_content and split_at answer from it,
+        and edits made through Tokens keep it in step.
+        Edits made to the tokens list directly are not seen
+        """
+        self.indexed = True
+        if self.brackets is None or self.brackets.size != len(self.tokens):
+            self.brackets = BracketIndex(self.tokens)
+        return self.brackets
+
+    def changed(self, start:int=None, end:int=None, count:int=None):
+        """
+        Keep the bracket index in step after tokens [start, end) were replaced by count tokens,
+        or without a splice (or one it cannot follow) drop it for the next query to rebuild
+        """
+        if self.brackets is None:
+            return
+        if start is None or not self.brackets.splice(self.tokens, start, end, count):
+            self.brackets = None
+
+    def position(self, index:int):
+        """
+        Get where index is as list.insert and slices take it, clamped to the tokens
+        """
+        n = len(self.tokens)
+        if index < 0:
+            index += n
+        return max(0, min(index, n))
 
     def valid_next(self, search:str, valid_tokens:set):
         """
@@ -82,22 +135,9 @@ class Tokens:
         is after the search token
         None = End of file
         """
-        i = 0
-        n = len(self.tokens)
-        while i < n:
-            if self.tokens[i] == search:
-                # this is the last token
-                if i + 1 >= n:
-                    # throw error if this is not allowed to be the last token
-                    if None not in valid_tokens:
-                        error_message = f"Expected one of '{list(valid_tokens)}' after '{search}'. Found EOF."
-                        self.tokens[i].error(error_message)
-                else:
-                    if self.tokens[i+1] not in valid_tokens:
-                        error_message = f"Expected one of '{list(valid_tokens)}' after '{search}'. Found '{self.tokens[i+1]}'."
-                        self.tokens[i].error(error_message)
-
-            i += 1
+        validator = Validator()
+        validator.valid_next(search, valid_tokens)
+        validator.check(self)
 
 
     def valid_last(self, search:str, valid_tokens:set):
@@ -106,22 +146,9 @@ class Tokens:
         is before the search token
         None = Beginning of file
         """
-        i = 0
-        n = len(self.tokens)
-        while i < n:
-            if self.tokens[i] == search:
-                # this is the last token
-                if i == 0:
-                    # throw error if this is not allowed to be the last token
-                    if None not in valid_tokens:
-                        error_message = f"Expected one of '{list(valid_tokens)}' before '{search}'. Found BOF."
-                        self.tokens[i].error(error_message)
-                else:
-                    if self.tokens[i-1] not in valid_tokens:
-                        error_message = f"Expected one of '{list(valid_tokens)}' before '{search}'. Found '{self.tokens[i-1]}'."
-                        self.tokens[i].error(error_message)
-
-            i += 1
+        validator = Validator()
+        validator.valid_last(search, valid_tokens)
+        validator.check(self)
 
 
     def check_valid(self, valid_tokens:set):
@@ -129,26 +156,17 @@ class Tokens:
         Check if all tokens are present in the set of valid tokens,
         else throw a fatal error
         """
-        i = 0
-        n = len(self.tokens)
-        while i < n:
-            if self.tokens[i] not in valid_tokens:
-                self.tokens[i].fatal_error(f"Token '{self.tokens[i]}' is invalid...\n\tvalid tokens: {list(valid_tokens)}")
-            i += 1
+        validator = Validator()
+        validator.check_valid(valid_tokens)
+        validator.check(self)
 
 
     def remove_all(self, search:str):
         """
         Remove all occurrences of a token.
         """
-        i = 0
-        n = len(self.tokens)
-        while i < n:
-            if self.tokens[i] == search:
-                del self.tokens[i]
-                i -= 1
-                n -= 1
-            i += 1
+        self.tokens[:] = [x for x in self.tokens if not x == search]
+        self.changed()
 
     def replace_all_single(self, search:Token, replace:Token):
         i = 0
@@ -162,42 +180,46 @@ class Tokens:
     def replace_all(self, search:list[str], replace:list[str]):
         """
         Replace all occurances of some tokens with some other tokens
+        Occurances are replaced left to right, and the search starts again at the first token of each replacement,
+        so a replacement that makes a new occurance with the tokens after it is replaced too.
+        New tokens take the position of the first token they replace
         """
-        i = 0
-        n = len(self.tokens)
-        while i < n:
-            j = 0
-            for j in range(len(search)):
-                if search[j] != self.tokens[i+j]:
-                    j = 0
-                    break
-            if j != 0:
-                for j in range(len(search)):
-                    del self.tokens[i]
-                    n -= 1
-
-                for tok in reversed(replace):
-                    self.tokens.insert(i, Token(tok, self.tokens[i].filename, self.tokens[i].line_number))
-                    n += 1
-
-                i -= 1
+        m = len(search)
+        if m == 0:
+            return
 
-            i += 1
+        result = []
+        # tokens still to be searched, the next one last, so a replacement is pushed back onto it
+        pending = self.tokens[::-1]
+        while len(pending) > 0:
+            if len(pending) >= m and all(pending[-1-j] == search[j] for j in range(m)):
+                first = pending[-1]
+                del pending[-m:]
+                pending.extend(Token(x, first.filename, first.line_number) for x in reversed(replace))
+            else:
+                result.append(pending.pop())
+        self.tokens[:] = result
+        self.changed()
+
+    def matches_at(self, index:int, search:list[str]):
+        """
+        Check if the tokens from index are search
+        """
+        if index + len(search) > len(self.tokens):
+            return False
+        for j in range(len(search)):
+            if self.tokens[index+j] != search[j]:
+                return False
+        return True
 
 
     def error_all(self, search:str, error_message:str, fatal:bool=True):
         """
         Throw an error at all occurances of some tokens
         """
-        i = 0
-        n = len(self.tokens)
-        while i < n:
-            if self.tokens[i] == search:
-                if fatal:
-                    self.tokens[i].fatal_error(error_message)
-                else:
-                    self.tokens[i].error(error_message)
-            i += 1
+        validator = Validator()
+        validator.error_all(search, error_message, fatal)
+        validator.check(self)
 
     def combine_all(self, search:list[str]):
         """
@@ -208,25 +230,26 @@ class Tokens:
         if m == 0:
             return
 
+        result = []
         i = 0
         n = len(self.tokens)
         while i < n:
-            j = 0
-            for j in range(m):
-                if self.tokens[i+j] != search[j]:
-                    j = 0
-                    break
-            if j != 0:
-                for j in range(m-1):
-                    self.tokens[i].token += self.tokens[i+1].token
-                    del self.tokens[i+1]
-                    n -= 1
-            i += 1
+            if self.matches_at(i, search):
+                self.tokens[i].token += "".join(x.token for x in self.tokens[i+1:i+m])
+                result.append(self.tokens[i])
+                i += m
+            else:
+                result.append(self.tokens[i])
+                i += 1
+        self.tokens[:] = result
+        self.changed()
 
 
     def combine(self, index):
+        index = self.position(index)
         self.tokens[index].token += self.tokens[index+1].token
         del self.tokens[index+1]
+        self.changed(index, index + 2, 1)
 
 
     def index(self, value):
@@ -237,23 +260,42 @@ class Tokens:
         """
         Remove tokens from index until (and including) the ending token
         """
-        result = []
+        i = index
         while True:
-            if index >= len(self.tokens):
+            if i >= len(self.tokens):
                 self.tokens[-1].fatal_error(f"Expected {end} before EOF")
-
-            result.append(self.tokens[index])
-
-            if self.tokens[index] == end:
-                del self.tokens[index]
+            if self.tokens[i] == end:
                 break
+            i += 1
 
-            del self.tokens[index]
-
+        result = self.tokens[index:i+1]
+        del self.tokens[index:i+1]
+        self.changed(index, i + 1, 0)
         return result
 
 
     def split_at(self, delimiter):
+        if self.indexed and str(delimiter) not in BracketIndex.CLOSERS and str(delimiter) not in BracketIndex.PAIRS:
+            brackets = self.bracket_index()
+            if brackets.balanced:
+                # only the tokens at depth 0 are visited, each bracket jumps to its match
+                result = []
+                start = 0
+                i = 0
+                n = len(self.tokens)
+                while i < n:
+                    if brackets.partner[i] > 0:
+                        i += brackets.partner[i]
+                    elif brackets.depth[i+1] > 0:
+                        # never closed, nothing after it is at depth 0
+                        break
+                    elif delimiter == self.tokens[i]:
+                        result.append(Tokens(self.tokens[start:i]))
+                        start = i + 1
+                    i += 1
+                result.append(Tokens(self.tokens[start:]))
+                return result
+
         result = []
         current = Tokens([])
 
@@ -316,6 +358,9 @@ class Tokens:
         using a stack that opens at each occurance of index
         """
         opener = self.tokens[index]
+        if self.indexed and BracketIndex.PAIRS.get(str(opener)) == str(closer):
+            return self.bracket_index().match(index)
+
         i = index
         n = len(self.tokens)
         opened = 0
@@ -342,7 +387,8 @@ class Tokens:
             return None
 
         contents = self.tokens[index:end+1]
-        self.tokens = self.tokens[:index] + self.tokens[end+1:]
+        del self.tokens[index:end+1]
+        self.changed(index, end + 1, 0)
 
         return contents
 
@@ -360,8 +406,25 @@ class Tokens:
         return contents
 
     def insert_all(self, index:int, toks:list[Token]):
-        for tok in reversed(toks):
-            self.tokens.insert(index, tok)
+        index = self.position(index)
+        toks = list(toks)
+        self.tokens[index:index] = toks
+        self.changed(index, index, len(toks))
+
+    @contextlib.contextmanager
+    def edit(self):
+        """
+        Collect splices and make them all at once when the block ends, in one pass over the tokens
+            with tokens.edit() as edit:
+                edit.replace(2, 4, [x])
+                edit.delete(7, 9)
+        Indices are into the tokens as they were before the block, and nothing changes if it raises
+        """
+        edit = TokenEdit(len(self.tokens))
+        yield edit
+        if len(edit.splices) > 0:
+            self.tokens[:] = edit.apply(self.tokens)
+            self.changed()
 
     def __str__(self):
         return str(self.tokens)
@@ -371,8 +434,19 @@ class Tokens:
         return self.tokens[index]
     def __setitem__(self, index, value):
         self.tokens[index] = value
+        if isinstance(index, slice):
+            self.changed()
+        else:
+            index = self.position(index)
+            self.changed(index, index + 1, 1)
     def __delitem__(self, index):
+        if isinstance(index, slice):
+            del self.tokens[index]
+            self.changed()
+            return
+        index = self.position(index)
         del self.tokens[index]
+        self.changed(index, index + 1, 0)
     def __iter__(self):
         return iter(self.tokens)
     def __len__(self):
@@ -381,16 +455,509 @@ class Tokens:
         return item in self.tokens
     def append(self, item):
         self.tokens.append(item)
+        self.changed(len(self.tokens) - 1, len(self.tokens) - 1, 1)
     def extend(self, iterable):
+        n = len(self.tokens)
         self.tokens.extend(iterable)
+        self.changed(n, n, len(self.tokens) - n)
     def insert(self, index, item):
+        index = self.position(index)
         self.tokens.insert(index, item)
+        self.changed(index, index, 1)
     def remove(self, item):
-        self.tokens.remove(item)
+        index = self.tokens.index(item)
+        del self.tokens[index]
+        self.changed(index, index + 1, 0)
     def pop(self, index=-1):
+        index = self.position(index)
         self.tokens.pop(index)
+        self.changed(index, index + 1, 0)
     def clear(self):
         self.tokens.clear()
+        self.changed()
+
+
+
+class TokenEdit:
+    """
+    Splices waiting to be made by Tokens.edit
+    """
+    def __init__(self, size:int):
+        self.size = size
+        # (start, end, tokens) in the order they were given
+        self.splices = []
+
+    def replace(self, start:int, end:int, tokens:list[Token]):
+        """
+        Replace the tokens in [start, end) with tokens
+        """
+        start = max(0, min(start, self.size))
+        end = max(start, min(end, self.size))
+        self.splices.append((start, end, list(tokens)))
+
+    def delete(self, start:int, end:int):
+        self.replace(start, end, [])
+
+    def insert(self, index:int, tokens:list[Token]):
+        self.replace(index, index, tokens)
+
+    def apply(self, tokens:list[Token]):
+        """
+        Get tokens with every splice made
+        Inserts at the same index keep the order they were given in
+        """
+        order = sorted(range(len(self.splices)), key=lambda k: (self.splices[k][0], self.splices[k][1], k))
+        result = []
+        i = 0
+        for k in order:
+            start, end, replacement = self.splices[k]
+            if start < i:
+                raise ValueError(f"Edit of [{start}, {end}) overlaps another")
+            result.extend(tokens[i:start])
+            result.extend(replacement)
+            i = end
+        result.extend(tokens[i:])
+        return result
+
+
+
+class Validator:
+    """
+    Checks many rules of the Tokens.valid_next, valid_last, check_valid and error_all kinds in one pass.
+    Rules are kept in a table by the token they are about, so each token costs one lookup
+    however many rules there are, and every error found is reported at once
+    """
+    def __init__(self):
+        # (valid after, valid before, error messages) of each search token
+        self.rules = {}
+        # (search, rules) of search tokens with an __eq__ of their own like TOKEN_VARIABLE,
+        # which can not be looked up so are compared with every token
+        self.patterns = []
+        # every set of valid tokens with its message, and the tokens valid in all of them
+        self.valid = []
+        self.all_valid = None
+
+    def rules_of(self, search:str):
+        if isinstance(search, Token) and type(search).__eq__ is not Token.__eq__:
+            for pattern, rules in self.patterns:
+                if pattern is search:
+                    return rules
+            self.patterns.append((search, ([], [], [])))
+            return self.patterns[-1][1]
+        search = str(search)
+        if search not in self.rules:
+            self.rules[search] = ([], [], [])
+        return self.rules[search]
+
+    def valid_next(self, search:str, valid_tokens:set, fatal:bool=False):
+        """
+        Make it an error for a token not in valid_tokens to be after search, None for the end of the tokens
+        """
+        expected = f"Expected one of '{list(valid_tokens)}' after '{search}'."
+        self.rules_of(search)[0].append((set(valid_tokens), expected, fatal))
+
+    def valid_last(self, search:str, valid_tokens:set, fatal:bool=False):
+        """
+        Make it an error for a token not in valid_tokens to be before search, None for the start of the tokens
+        """
+        expected = f"Expected one of '{list(valid_tokens)}' before '{search}'."
+        self.rules_of(search)[1].append((set(valid_tokens), expected, fatal))
+
+    def check_valid(self, valid_tokens:set, fatal:bool=True):
+        """
+        Make it an error for any token to not be in valid_tokens
+        """
+        listed = f"valid tokens: {list(valid_tokens)}"
+        valid_tokens = {str(x) for x in valid_tokens}
+        self.valid.append((valid_tokens, listed, fatal))
+        self.all_valid = valid_tokens if self.all_valid is None else self.all_valid & valid_tokens
+
+    def error_all(self, search:str, error_message:str, fatal:bool=True):
+        """
+        Make every occurance of search an error
+        """
+        self.rules_of(search)[2].append((error_message, fatal))
+
+    def check(self, tokens):
+        """
+        Check tokens against every rule and give the errors to errors.ERROR_HANDLER in one batch,
+        exiting after if any of them is fatal
+        Returns the errors
+        """
+        found = []
+        fatal = False
+        n = len(tokens)
+        for i in range(n):
+            token = tokens[i]
+            x = str(token)
+            if self.all_valid is not None and x not in self.all_valid:
+                for valid_tokens, listed, is_fatal in self.valid:
+                    if x not in valid_tokens:
+                        found.append(token.make_error(f"Token '{x}' is invalid...\n\t{listed}"))
+                        fatal = fatal or is_fatal
+
+            rules = self.rules.get(x)
+            matched = [] if rules is None else [rules]
+            if len(self.patterns) > 0:
+                matched += [rules for search, rules in self.patterns if token == search]
+            for after, before, messages in matched:
+                for valid_tokens, expected, is_fatal in after:
+                    if i + 1 >= n:
+                        if None not in valid_tokens:
+                            found.append(token.make_error(f"{expected} Found EOF."))
+                            fatal = fatal or is_fatal
+                    elif tokens[i+1] not in valid_tokens:
+                        found.append(token.make_error(f"{expected} Found '{tokens[i+1]}'."))
+                        fatal = fatal or is_fatal
+                for valid_tokens, expected, is_fatal in before:
+                    if i == 0:
+                        if None not in valid_tokens:
+                            found.append(token.make_error(f"{expected} Found BOF."))
+                            fatal = fatal or is_fatal
+                    elif tokens[i-1] not in valid_tokens:
+                        found.append(token.make_error(f"{expected} Found '{tokens[i-1]}'."))
+                        fatal = fatal or is_fatal
+                for message, is_fatal in messages:
+                    found.append(token.make_error(message))
+                    fatal = fatal or is_fatal
+
+        errors.ERROR_HANDLER.add_errors(found, fatal)
+        return found
+
+
+class BracketIndex:
+    """
+    The matching bracket and the bracket depth of every position of a token list, built in one pass.
+    Brackets are matched with a stack for each kind, so the match of an opener is what
+    Tokens.get_match_end scans for even when kinds cross.
+    Depth counts the brackets open before a position, ignoring closers with nothing open like parallel.statement_ends
+    """
+    PAIRS = {"(": ")", "{": "}", "[": "]"}
+    CLOSERS = {")": "(", "}": "{", "]": "["}
+
+    def __init__(self, tokens:list):
+        # matching bracket of each position as an offset from it, 0 for none
+        # offsets only change for the pairs around an edit, not for every pair after it
+        self.partner, self.depth, self.balanced, self.closed = self.scan(tokens)
+        self.size = len(tokens)
+
+    @staticmethod
+    def scan(tokens:list):
+        """
+        Get the offsets to matching brackets, the depth before every position and after the last,
+        if every closer closes the last bracket opened, and if then nothing is left open
+        """
+        n = len(tokens)
+        partner = [0] * n
+        depth = [0] * (n + 1)
+        stacks = {x: [] for x in BracketIndex.PAIRS}
+        opened = []
+        balanced = True
+        d = 0
+        for i, x in enumerate(tokens):
+            depth[i] = d
+            x = str(x)
+            if x in BracketIndex.PAIRS:
+                stacks[x].append(i)
+                opened.append(x)
+                d += 1
+            elif x in BracketIndex.CLOSERS:
+                stack = stacks[BracketIndex.CLOSERS[x]]
+                if len(stack) > 0:
+                    start = stack.pop()
+                    partner[start] = i - start
+                    partner[i] = start - i
+                if len(opened) > 0 and opened[-1] == BracketIndex.CLOSERS[x]:
+                    opened.pop()
+                else:
+                    balanced = False
+                if d > 0:
+                    d -= 1
+        depth[n] = d
+        return partner, depth, balanced, balanced and d == 0
+
+    def match(self, index:int):
+        """
+        Get the index of the bracket matching the one at index, or None
+        """
+        offset = self.partner[index]
+        return index + offset if offset != 0 else None
+
+    def depth_at(self, index:int):
+        """
+        Get the number of brackets open before index
+        """
+        return self.depth[index]
+
+    def splice(self, tokens:list, start:int, end:int, count:int):
+        """
+        Follow tokens [start, end) being replaced by the count tokens now at tokens[start:start+count]
+        Only splices that take out and put in whole bracket pairs are followed
+        Returns False if the index has to be built again
+        """
+        if not self.balanced or self.size - (end - start) + count != len(tokens):
+            return False
+        d = self.depth[start]
+        if self.depth[end] != d or min(self.depth[start:end+1]) < d:
+            return False
+        partner, depth, balanced, closed = self.scan(tokens[start:start+count])
+        if not closed:
+            return False
+
+        change = count - (end - start)
+        self.partner[start:end] = partner
+        self.depth[start:end] = [d + x for x in depth[:-1]]
+        self.size = len(tokens)
+
+        # the pairs around the splice are closed where the depth first falls below it
+        i = start + count
+        for level in range(d - 1, -1, -1):
+            try:
+                i = self.depth.index(level, i)
+            except ValueError:
+                # left open, and so is every bracket around it
+                break
+            closer = i - 1
+            opener = closer + self.partner[closer] - change
+            self.partner[opener] = closer - opener
+            self.partner[closer] = opener - closer
+        return True
+
+
+class SymbolTable:
+    """
+    Interns token strings to small ints
+    """
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, string:str):
+        """
+        Get the id of string, giving it the next id if it is new
+        """
+        symbol = self.ids.get(string)
+        if symbol is None:
+            symbol = len(self.strings)
+            self.ids[string] = symbol
+            self.strings.append(string)
+        return symbol
+
+    def lookup(self, string:str):
+        """
+        Get the id of string, or -1 if it has never been interned
+        """
+        return self.ids.get(string, -1)
+
+    def string(self, symbol:int):
+        return self.strings[symbol]
+
+    def token(self, symbol:int):
+        return Token(self.strings[symbol], "", 0)
+
+    def __len__(self):
+        return len(self.strings)
+
+
+
+class Piece:
+    """
+    A run of tokens from one of a PieceTable's buffers.
+    Pieces form a treap ordered by position in the sequence
+    """
+    def __init__(self, buffer:list, start:int, length:int, priority:float):
+        self.buffer = buffer
+        self.start = start
+        self.length = length
+        self.priority = priority
+        self.left = None
+        self.right = None
+        # number of tokens in this subtree
+        self.size = length
+
+    def update(self):
+        self.size = self.length
+        if self.left is not None:
+            self.size += self.left.size
+        if self.right is not None:
+            self.size += self.right.size
+
+
+class PieceTable:
+    """
+    Holds a list of tokens that can be rewritten in place.
+    The original list is never copied or modified: replacements are
+    appended to an add buffer and the sequence is a balanced tree of
+    pieces of the two buffers, so replace() is O(log n) plus the size
+    of the replacement.
+    """
+    def __init__(self, tokens:list[Token]=[], seed:int=0):
+        self.original = tokens
+        self.added = []
+        self.random = random.Random(seed)
+        self.root = None
+        if len(tokens) > 0:
+            self.root = Piece(self.original, 0, len(tokens), self.random.random())
+        # the last piece found by a lookup, and the index it starts at
+        self.cursor = None
+        self.cursor_start = 0
+
+    def replace(self, start:int, end:int, tokens:list[Token]):
+        """
+        Replace the tokens in [start, end) with tokens
+        """
+        n = len(self)
+        start = max(0, min(start, n))
+        end = max(start, min(end, n))
+
+        left, rest = self.split(self.root, start)
+        _, right = self.split(rest, end - start)
+
+        middle = None
+        if len(tokens) > 0:
+            middle = Piece(self.added, len(self.added), len(tokens), self.random.random())
+            self.added.extend(tokens)
+
+        self.root = self.merge(self.merge(left, middle), right)
+        self.cursor = None
+
+    def split(self, node:Piece, index:int):
+        """
+        Split a subtree into its first index tokens and the rest
+        """
+        if node is None:
+            return None, None
+
+        left_size = node.left.size if node.left is not None else 0
+        if index <= left_size:
+            left, right = self.split(node.left, index)
+            node.left = right
+            node.update()
+            return left, node
+        if index >= left_size + node.length:
+            left, right = self.split(node.right, index - left_size - node.length)
+            node.right = left
+            node.update()
+            return node, right
+
+        # the split falls inside this piece
+        cut = index - left_size
+        tail = Piece(node.buffer, node.start + cut, node.length - cut, self.random.random())
+        right = self.merge(tail, node.right)
+        node.length = cut
+        node.right = None
+        node.update()
+        return node, right
+
+    def merge(self, left:Piece, right:Piece):
+        """
+        Join two subtrees, all of left's tokens coming first
+        """
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self.merge(left.right, right)
+            left.update()
+            return left
+        right.left = self.merge(left, right.left)
+        right.update()
+        return right
+
+    def find(self, index:int):
+        """
+        Get the piece holding index and the index that piece starts at
+        """
+        if self.cursor is not None and self.cursor_start <= index < self.cursor_start + self.cursor.length:
+            return self.cursor, self.cursor_start
+
+        node = self.root
+        offset = 0
+        while node is not None:
+            left_size = node.left.size if node.left is not None else 0
+            if index < offset + left_size:
+                node = node.left
+            elif index < offset + left_size + node.length:
+                self.cursor = node
+                self.cursor_start = offset + left_size
+                return node, self.cursor_start
+            else:
+                offset += left_size + node.length
+                node = node.right
+        raise IndexError("PieceTable index out of range")
+
+    def pieces(self):
+        """
+        Iterate over the pieces in order
+        """
+        stack = []
+        node = self.root
+        while len(stack) > 0 or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node
+            node = node.right
+
+    def to_list(self):
+        """
+        Materialize the current sequence as a list
+        """
+        result = []
+        for piece in self.pieces():
+            result.extend(piece.buffer[piece.start:piece.start+piece.length])
+        return result
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.to_list()[index]
+            result = []
+            i = start
+            while i < stop:
+                piece, piece_start = self.find(i)
+                begin = piece.start + i - piece_start
+                count = min(stop - i, piece.length - (i - piece_start))
+                result.extend(piece.buffer[begin:begin+count])
+                i += count
+            return result
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("PieceTable index out of range")
+        piece, piece_start = self.find(index)
+        return piece.buffer[piece.start + index - piece_start]
+
+    def __setitem__(self, index, value):
+        if index < 0:
+            index += len(self)
+        self.replace(index, index + 1, [value])
+    def __delitem__(self, index):
+        if index < 0:
+            index += len(self)
+        self.replace(index, index + 1, [])
+    def __len__(self):
+        return self.root.size if self.root is not None else 0
+    def __iter__(self):
+        for piece in self.pieces():
+            for i in range(piece.start, piece.start + piece.length):
+                yield piece.buffer[i]
+    def __contains__(self, item):
+        return any(x == item for x in self)
+    def __str__(self):
+        return str(self.to_list())
+    def __repr__(self):
+        return repr(self.to_list())
+    def append(self, item):
+        self.replace(len(self), len(self), [item])
+    def extend(self, iterable):
+        self.replace(len(self), len(self), list(iterable))
+    def insert(self, index, item):
+        self.replace(index, index, [item])
 
 
 
@@ -399,6 +966,8 @@ class TOKEN_ANY(Token):
     """
     Special Token that is equal to any str
     """
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -409,6 +978,8 @@ class TOKEN_VARIABLE(Token):
     Special Token that is equal to any str in the form
     #{int}
     """
+    __slots__ = ()
+
     def __init__(self):
         Token.__init__(self, "", "", 0)
 
@@ -431,6 +1002,8 @@ class TOKEN_INTEGER(Token):
     """
     Special Token that is equal to any str that is an int
     """
+    __slots__ = ()
+
     def __init__(self):
         Token.__init__(self, "", "", 0)
 
@@ -450,6 +1023,8 @@ class TOKEN_FLOAT(Token):
     """
     Special Token that is equal to any str that is a float
     """
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -459,6 +1034,8 @@ class TOKEN_FROM_LIST(Token):
     """
     Special Token that is equal to any str from given list
     """
+    __slots__ = ()
+
     def __init__(self):
         """
         Special Token that is equal to any literal token
@@ -467,6 +1044,8 @@ class TOKEN_FROM_LIST(Token):
 
 
 class TOKEN_LITERAL(Token):
+    __slots__ = ()
+
     def __init__(self):
         Token.__init__(self, "", "", 0)
 
@@ -486,6 +1065,8 @@ class TypeToken(Token):
     """
     Special Token that is a replacement for multiple type tokens
     """
+    __slots__ = ("value",)
+
     def __init__(self, token, filename, line_number, value:list[Token]=[]):
         Token.__init__(self, token, filename, line_number)
         self.value = value
@@ -499,6 +1080,8 @@ class VariableToken(Token):
     """
     Special Token that is a replacement for an identifier
     """
+    __slots__ = ("original", "type")
+
     def __init__(self, token, filename, line_number, original:Token, the_type:Token):
         Token.__init__(self, token, filename, line_number)
         self.original = original
@@ -509,6 +1092,8 @@ class EnumToken(Token):
     """
     Special Token that is a replacement for an enum
     """
+    __slots__ = ("name", "value", "mappings")
+
     def __init__(self, token, filename, line_number, name=None, value=[]):
         Token.__init__(self, token, filename, line_number)
         self.name = name
@@ -523,6 +1108,8 @@ class StructToken(Token):
     """
     Special Token that is a replacement for an enum
     """
+    __slots__ = ("name", "value", "mappings")
+
     def __init__(self, token, filename, line_number, name=None, value=[]):
         Token.__init__(self, token, filename, line_number)
         self.name = name
@@ -537,6 +1124,8 @@ class UnionToken(Token):
     """
     Special Token that is a replacement for an enum
     """
+    __slots__ = ("name", "value", "mappings")
+
     def __init__(self, token, filename, line_number, name=None, value=[]):
         Token.__init__(self, token, filename, line_number)
         self.name = name
@@ -551,6 +1140,8 @@ class TypedefToken(Token):
     """
     Special Token that is a replacement for an enum
     """
+    __slots__ = ("original_value", "new_value")
+
     def __init__(self, token, filename, line_number, original_value:Token, new_value:Token):
         Token.__init__(self, token, filename, line_number)
         self.original_value = original_value
@@ -564,6 +1155,8 @@ class FuncToken(Token):
     """
     Special Token that is a replacement for a function
     """
+    __slots__ = ("name", "name_value", "return_type", "args", "value")
+
     def __init__(self, token, name_value, filename, line_number, name:str, return_type:str, args:list[Token], value:list[Token]):
         Token.__init__(self, token, filename, line_number)
         self.name = name
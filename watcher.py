@@ -0,0 +1,148 @@
+
+import os
+import sys
+import threading
+
+import errors
+import rba_v2
+
+
+def rule_key(rule:list):
+    """
+    Identify a lexed rule by the text and metric of its clauses
+    """
+    return tuple((tuple(str(x) for x in clause.content), clause.metric) for clause in rule)
+
+
+class RuleWatcher:
+    """
+    Keeps a Graph in step with its database files while it is in use.
+    poll() adds the rules that appeared in changed files and removes the ones that went,
+    all as one new version of the graph, so execute calls already running
+    keep the rules they started with. An edited rule is removed and added again.
+    start() polls in a background thread every interval seconds
+    """
+    def __init__(self, database_filenames:list[str], direction:int, metric:int, interval:float=1.0):
+        self.database_filenames = list(database_filenames)
+        self.direction = direction
+        self.metric = metric
+        self.interval = interval
+        self.graph = rba_v2.Graph()
+        # (mtime, size) of each file when it was last read
+        self.stamps = {}
+        # ids of the rules loaded from each file, by rule key
+        self.loaded = {filename: {} for filename in self.database_filenames}
+        self.thread = None
+        self.stopping = threading.Event()
+        self.poll()
+
+    def read(self, filename:str):
+        """
+        Lex a database file
+        Returns its rules, or None if it has errors so the rules loaded before are kept
+        """
+        handler = errors.ERROR_HANDLER
+        count = len(handler.errors)
+        try:
+            rules = [rule for line, rule in rba_v2.read_database(filename, self.metric, self.direction)]
+        except SystemExit:
+            # a fatal error in an edit should not stop the optimizer using the graph
+            rules = None
+        if len(handler.errors) > count:
+            for error in handler.errors[count:]:
+                print(f"[Watcher] Keeping the old rules of {filename}, error at line {error.line_number}: {error.message}")
+            del handler.errors[count:]
+            rules = None
+        return rules
+
+    def poll(self):
+        """
+        Apply the changes made to the database files since the last poll
+        Returns the number of rules added and removed
+        """
+        removed = []
+        added = []
+        for filename in self.database_filenames:
+            try:
+                info = os.stat(filename)
+            except OSError:
+                # editors can replace a file by removing it first, wait for it to come back
+                continue
+            stamp = (info.st_mtime_ns, info.st_size)
+            if self.stamps.get(filename) == stamp:
+                continue
+            self.stamps[filename] = stamp
+
+            rules = self.read(filename)
+            if rules is None:
+                continue
+
+            # rules are matched by key, repeats of a rule are counted separately
+            old = self.loaded[filename]
+            new = {}
+            for rule in rules:
+                new.setdefault(rule_key(rule), []).append(rule)
+            for key, rule_ids in old.items():
+                keep = len(new.get(key, []))
+                removed += rule_ids[keep:]
+                del rule_ids[keep:]
+            for key, same in new.items():
+                rule_ids = old.setdefault(key, [])
+                for rule in same[len(rule_ids):]:
+                    added.append((filename, key, rba_v2.prepare_rule(rule, self.direction)))
+            for key in [key for key, rule_ids in old.items() if len(rule_ids) == 0]:
+                del old[key]
+
+        if len(removed) == 0 and len(added) == 0:
+            return 0
+
+        # one lock for the whole change, so no snapshot sees half of it
+        with self.graph.lock:
+            for rule_id in removed:
+                self.graph.remove_rule(rule_id)
+            rule_ids = self.graph.add_rules([rule for filename, key, rule in added])
+        for (filename, key, rule), rule_id in zip(added, rule_ids):
+            self.loaded[filename].setdefault(key, []).append(rule_id)
+        return len(removed) + len(added)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            changes = self.poll()
+            if changes > 0:
+                print(f"[Watcher] Applied {changes} rule changes, graph version {self.graph.version}")
+
+    def start(self):
+        """
+        Poll in a background thread until stop is called
+        """
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print(f"Usage: {sys.argv[0]} <direction> <metric> <database>...")
+        print("Reads tokens separated by whitespace from each input line and prints them optimized,")
+        print("with the rules of the databases as they are when the line is read")
+        exit(1)
+
+    watcher = RuleWatcher(sys.argv[3:], int(sys.argv[1]), int(sys.argv[2]))
+    watcher.start()
+    varnum = 0
+    for line in sys.stdin:
+        result, varnum = watcher.graph.execute(line.split(), varnum=varnum)
+        if result is False:
+            print("No replacement could be made")
+            continue
+        print(" ".join(str(x) for x in result))
+    watcher.stop()